@@ -0,0 +1,292 @@
+#load test for httpd.py: starts the server, runs every scenario with a pool of client
+#processes and reports requests per second and latency percentiles. --out writes the
+#results as json, --compare checks them against an earlier run
+import socket
+import subprocess
+import multiprocessing
+import sys,os
+import getopt
+import time
+import json
+import math
+from array import array
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def chunked_body(datas, size):
+    parts = []
+    for i in range(0, len(datas), size):
+        piece = datas[i:i+size]
+        parts.append(b"%x\r\n%s\r\n" % (len(piece), piece))
+    parts.append(b"0\r\n\r\n")
+    return b"".join(parts)
+
+upload = b"color=red&pad=" + b"x" * 65536
+
+#name: (request bytes, keep the connection open)
+scenarios = {
+    "static_index": (b"GET /index.html HTTP/1.1\r\nHost: bench\r\n\r\n", True),
+    "static_index_close": (b"GET /index.html HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n", False),
+    "favicon": (b"GET /favicon.ico HTTP/1.1\r\nHost: bench\r\n\r\n", True),
+    "color_post": (b"POST /color.py?index.html HTTP/1.1\r\nHost: bench\r\nContent-Type: application/x-www-form-urlencoded\r\n"
+                   b"Content-Length: 9\r\n\r\ncolor=red", True),
+    "chunked_upload": (b"POST /color.py?index.html HTTP/1.1\r\nHost: bench\r\nContent-Type: application/x-www-form-urlencoded\r\n"
+                       b"Transfer-Encoding: chunked\r\n\r\n"
+                       + chunked_body(upload, 4096), True),
+}
+
+class ResponseReader:
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = b''
+
+    def _more(self):
+        datas = self.sock.recv(65536)
+        if not datas:
+            raise ConnectionError("closed by server")
+        self.buf += datas
+
+    def _line(self):
+        while b"\r\n" not in self.buf:
+            self._more()
+        line, self.buf = self.buf.split(b"\r\n", 1)
+        return line
+
+    #returns (status, server keeps the connection)
+    def read(self):
+        while b"\r\n\r\n" not in self.buf:
+            self._more()
+        head, self.buf = self.buf.split(b"\r\n\r\n", 1)
+        lines = head.split(b"\r\n")
+        status = int(lines[0].split()[1])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(b":")
+            headers[name.strip().lower()] = value.strip().lower()
+        keep = headers.get(b"connection") != b"close"
+        if headers.get(b"transfer-encoding") == b"chunked":
+            while True:
+                size = int(self._line().split(b";")[0], 16)
+                if size == 0:
+                    while self._line():
+                        pass
+                    break
+                while len(self.buf) < size + 2:
+                    self._more()
+                self.buf = self.buf[size+2:]
+        elif b"content-length" in headers:
+            length = int(headers[b"content-length"])
+            while len(self.buf) < length:
+                self._more()
+            self.buf = self.buf[length:]
+        else:
+            try:
+                while True:
+                    self._more()
+            except ConnectionError:
+                pass
+            self.buf = b''
+            keep = False
+        return status, keep
+
+#one closed loop client: a request goes out when the previous response is complete
+def client(port, request, keepalive, start, stop, results):
+    latencies = array("d")
+    errors = 0
+    bad = 0
+    sock = reader = None
+    while time.time() < start:
+        time.sleep(0.001)
+    while True:
+        t = time.time()
+        if t >= stop:
+            break
+        try:
+            if sock is None:
+                sock = socket.create_connection(("127.0.0.1", port))
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                reader = ResponseReader(sock)
+            sock.sendall(request)
+            status, keep = reader.read()
+        except (OSError, ValueError, IndexError):
+            errors += 1
+            if sock:
+                sock.close()
+            sock = None
+            continue
+        latencies.append(time.time() - t)
+        if status >= 400:
+            bad += 1
+        if not keepalive or not keep:
+            sock.close()
+            sock = None
+    if sock:
+        sock.close()
+    results.put((latencies.tobytes(), errors, bad))
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[max(0, int(math.ceil(p * len(values))) - 1)]
+
+def run_scenario(port, name, procs, duration, warmup):
+    request, keepalive = scenarios[name]
+    results = multiprocessing.Queue()
+    start = time.time() + 0.5 # every process is up before the clock starts
+    if warmup > 0:
+        warm = [multiprocessing.Process(target=client, args=(port, request, keepalive, start, start + warmup, results))
+                for i in range(procs)]
+        for p in warm:
+            p.start()
+        for p in warm:
+            results.get()
+        for p in warm:
+            p.join()
+        start = time.time() + 0.5
+    workers = [multiprocessing.Process(target=client, args=(port, request, keepalive, start, start + duration, results))
+               for i in range(procs)]
+    for p in workers:
+        p.start()
+    latencies = array("d")
+    errors = bad = 0
+    for p in workers:
+        datas, e, b = results.get()
+        chunk = array("d")
+        chunk.frombytes(datas)
+        latencies.extend(chunk)
+        errors += e
+        bad += b
+    for p in workers:
+        p.join()
+    values = sorted(latencies)
+    return {
+        "requests": len(values),
+        "rps": round(len(values) / duration, 1),
+        "p50_ms": round(percentile(values, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+        "p999_ms": round(percentile(values, 0.999) * 1000, 3),
+        "errors": errors,
+        "non_2xx": bad,
+    }
+
+def wait_port(port, proc, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("server exited with status {}".format(proc.returncode))
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start listening on {}".format(port))
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=here,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#prints the change of every scenario, returns the ones that got worse than threshold
+def compare(old, new, threshold):
+    regressions = []
+    for name, cur in new["scenarios"].items():
+        prev = old.get("scenarios", {}).get(name)
+        if not prev or not prev["rps"]:
+            continue
+        rps = (cur["rps"] - prev["rps"]) / prev["rps"]
+        p99 = (cur["p99_ms"] - prev["p99_ms"]) / prev["p99_ms"] if prev["p99_ms"] else 0.0
+        worse = rps < -threshold or p99 > threshold
+        print("{:<20} rps {:>+7.1%}  p99 {:>+7.1%}{}".format(name, rps, p99, "  REGRESSION" if worse else ""))
+        if worse:
+            regressions.append(name)
+    return regressions
+
+def usage():
+    print("Usage: python bench.py [--port=8799] [--engine=thread|loop] [--procs=N] [--duration=5] [--warmup=1]")
+    print("           [--scenarios=a,b] [--server-args=ARGS] [--out=FILE] [--compare=FILE] [--threshold=0.1]")
+    print("  --procs       client processes, each one connection in a closed loop (default cpu count)")
+    print("  --scenarios   comma separated, from: " + ", ".join(scenarios))
+    print("  --server-args extra httpd.py options, e.g. \"--pool=8 --log-level=warn\"")
+    print("  --out         write the results as json")
+    print("  --compare     json of an earlier run, exits 1 when rps drops or p99 grows more than --threshold")
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", ["help", "port=", "engine=", "procs=", "duration=", "warmup=",
+            "scenarios=", "server-args=", "out=", "compare=", "threshold="])
+    except getopt.GetoptError as e:
+        print(e)
+        usage()
+        sys.exit(2)
+    port = 8799
+    engine = "thread"
+    procs = multiprocessing.cpu_count()
+    duration = 5.0
+    warmup = 1.0
+    names = list(scenarios)
+    server_args = []
+    out = oldfile = None
+    threshold = 0.1
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o == "--port":
+            port = int(a)
+        elif o == "--engine":
+            engine = a
+        elif o == "--procs":
+            procs = int(a)
+        elif o == "--duration":
+            duration = float(a)
+        elif o == "--warmup":
+            warmup = float(a)
+        elif o == "--scenarios":
+            names = [n.strip() for n in a.split(",") if n.strip()]
+        elif o == "--server-args":
+            server_args = a.split()
+        elif o == "--out":
+            out = a
+        elif o == "--compare":
+            oldfile = a
+        elif o == "--threshold":
+            threshold = float(a)
+    for name in names:
+        if name not in scenarios:
+            print("unknown scenario: " + name)
+            usage()
+            sys.exit(2)
+    cmd = [sys.executable, os.path.join(here, "httpd.py"), "--port={}".format(port), "--engine=" + engine] + server_args
+    server = subprocess.Popen(cmd, cwd=here, stdout=subprocess.DEVNULL)
+    report = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "engine": engine,
+        "server_args": server_args,
+        "procs": procs,
+        "duration": duration,
+        "scenarios": {},
+    }
+    try:
+        wait_port(port, server)
+        print("{:<20} {:>10} {:>10} {:>10} {:>10} {:>8}".format("scenario", "req/s", "p50 ms", "p99 ms", "p999 ms", "errors"))
+        for name in names:
+            r = run_scenario(port, name, procs, duration, warmup)
+            report["scenarios"][name] = r
+            print("{:<20} {:>10.1f} {:>10.3f} {:>10.3f} {:>10.3f} {:>8}".format(
+                name, r["rps"], r["p50_ms"], r["p99_ms"], r["p999_ms"], r["errors"] + r["non_2xx"]))
+    finally:
+        server.terminate()
+        server.wait()
+    if out:
+        with open(out, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if oldfile:
+        with open(oldfile) as f:
+            old = json.load(f)
+        print("compared with {} ({})".format(oldfile, old.get("commit")))
+        if compare(old, report, threshold):
+            sys.exit(1)
@@ -141,21 +141,25 @@ cnames = {
 'yellow':               '#FFFF00',
 'yellowgreen':          '#9ACD32'}
 
-if "QUERY_STRING" in os.environ:
-    query = os.environ["QUERY_STRING"]
+htdocs = os.path.dirname(os.path.realpath(__file__))
 
-body = sys.stdin.read()
-
-file = "htdocs/" + query
-if not os.path.isfile(file):
-    print("Error action.")
-else:
+#in-process page: the server calls handle(request), run directly it still works as a cgi
+def render(query, clrn):
+    #the template must be a file under htdocs, and not a script
+    file = os.path.realpath(os.path.join(htdocs, query.lstrip("/")))
+    if not file.startswith(htdocs + os.sep) or file.lower().endswith(".py") or not os.path.isfile(file):
+        return "Error action.\n"
     with open(file) as f:
-        clrn = body.split('=')[1]
         ret = f.read()
         if clrn in cnames:
             clrv = cnames[clrn]
             ret = ret.replace("background: #202a39;", "background: {};".format(clrv))
-        sys.stdout.write(ret)
+        return ret
 
+def handle(request):
+    return render(request.query, request.form.get("color", ""))
 
+if __name__ == "__main__":
+    from httpd import Form
+    query = os.environ.get("QUERY_STRING", "")
+    sys.stdout.write(render(query, Form.cgi().get("color", "")))
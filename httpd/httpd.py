@@ -2,43 +2,1226 @@
 # -*- coding: utf-8 -*-
 import socket
 import threading
-import re
 import subprocess
 import sys,os
+import getopt
 import signal
+import struct
+import selectors
+import collections
+import time
+import mimetypes
+import email.utils
+import email.message
+import shutil
+import binascii
+import tempfile
+import json
+import select
+import io
+import traceback
+import types
+import ast
+import zlib
+import random
+import atexit
+import bisect
+import cProfile
+import pstats
+import hashlib
 
 if sys.version_info.major == 3:
-    from urllib.parse import urlparse
+    from urllib.parse import urlparse, unquote, unquote_to_bytes
+    import queue
 else:
     from urlparse import urlparse
+    from urllib import unquote
+    from urllib import unquote as unquote_to_bytes
+    import Queue as queue
+
+keepalive_timeout = 10 # idle connection between requests
+keepalive_requests = 100
+header_timeout = 10 # whole request head, counted from its first byte
+body_timeout = 30 # longest pause while a request body arrives
+body_min_rate = 1024 # bytes/s a body must average once it has taken body_timeout
+write_timeout = 60
+max_conns_per_ip = 128 # 0: no cap
+cgi_workers = 0 if os.name == "nt" else 4 # 0: spawn python per request
+cgi_max_requests = 1000
+cgi_timeout = 30
+httpd_script = os.path.abspath(__file__)
+proxy_routes = [] # (pattern, UpstreamGroup) from --proxy
+proxy_balance = "round-robin"
+proxy_keepalive = 16 # idle connections kept per upstream
+proxy_timeout = 30 # longest wait for an upstream read or write
+proxy_connect_timeout = 5
+gzip_level = 6 # 0 turns compression off
+gzip_min_size = 256
+stats_path = "/__stats" # empty turns the metrics page off
+drain_timeout = 30 # seconds in-flight requests get after SIGTERM
+draining = False # set on SIGTERM, responses go out with Connection: close
+restart_timeout = 30 # seconds a restarted server may take to get ready
+
+#log records are formatted and written by a background thread, the request path only checks
+#the level and queues a tuple. When the writer falls behind records are dropped, not waited for
+class AsyncLog:
+    DEBUG, INFO, WARN, ERROR = 10, 20, 30, 40
+    levels = {"debug": DEBUG, "info": INFO, "warn": WARN, "error": ERROR}
+    names = {DEBUG: "DEBUG", INFO: "INFO", WARN: "WARN", ERROR: "ERROR"}
+    queue_size = 65536
+    batch = 512
+
+    def __init__(self, stream=None, level=INFO, sample=1.0):
+        self.stream = stream # None: sys.stdout
+        self.level = level
+        self.sample = sample # fraction of access records kept, 5xx are always logged
+        self.dropped = 0
+        self.pid = None
+        self.records = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def debug(self, *args):
+        if self.level <= self.DEBUG:
+            self._put((self.DEBUG, time.time(), args))
+
+    def info(self, *args):
+        if self.level <= self.INFO:
+            self._put((self.INFO, time.time(), args))
+
+    def warn(self, *args):
+        if self.level <= self.WARN:
+            self._put((self.WARN, time.time(), args))
+
+    def error(self, *args):
+        if self.level <= self.ERROR:
+            self._put((self.ERROR, time.time(), args))
+
+    def access(self, addr, method, path, status, size, duration):
+        if self.level > self.INFO:
+            return
+        if self.sample < 1.0 and status < 500 and random.random() >= self.sample:
+            return
+        self._put((None, time.time(), (addr, method, path, status, size, duration)))
+
+    def _put(self, record):
+        if self.pid != os.getpid(): # first record, or a forked child that has no writer thread
+            self._start()
+        try:
+            self.records.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.records = queue.Queue(self.queue_size)
+            self.thread = threading.Thread(target=self._write, args=(self.records,), name="httpd-log")
+            self.thread.daemon = True
+            self.thread.start()
+            self.pid = os.getpid()
+
+    @staticmethod
+    def format(record):
+        level, t, args = record
+        stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(t)) + ".%03d" % (t % 1 * 1000)
+        if level is None:
+            addr, method, path, status, size, duration = args
+            return "{} access addr={} method={} path={} status={} bytes={} duration_ms={:.3f}\n".format(
+                stamp, addr[0] if addr else "-", method or "-", path or "-", status, size, duration * 1000)
+        return "{} {} {}\n".format(stamp, AsyncLog.names[level], " ".join(str(a) for a in args))
+
+    def _write(self, records):
+        stream = self.stream or sys.stdout
+        running = True
+        while running:
+            lines = []
+            record = records.get()
+            while True:
+                if record is None:
+                    running = False
+                    break
+                lines.append(self.format(record))
+                if len(lines) >= self.batch:
+                    break
+                try:
+                    record = records.get_nowait()
+                except queue.Empty:
+                    break
+            if self.dropped:
+                lines.append(self.format((self.WARN, time.time(), ("log records dropped:", self.dropped))))
+                self.dropped = 0
+            try:
+                stream.write("".join(lines))
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+
+    #writes out what is queued, called at exit and before a forked worker ends
+    def close(self):
+        if self.pid != os.getpid():
+            return
+        self.records.put(None)
+        self.thread.join(5)
+        self.pid = None
+
+log = AsyncLog()
+atexit.register(log.close)
+
+class MetricsShard:
+    def __init__(self, thread):
+        self.thread = thread
+        self.counters = {}
+        self.histograms = {}
+
+#counters and latency histograms live in one shard per thread, so an update is a dict
+#operation on the caller's own shard with no lock. A scrape sums the shards and folds
+#those of finished threads into one. Gauges are functions sampled at scrape time
+class Metrics:
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    fold_threshold = 256
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        self.retired = MetricsShard(None)
+        self.gauges = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = MetricsShard(threading.current_thread())
+            with self.lock:
+                if len(self.shards) >= self.fold_threshold: # thread per connection leaves many behind
+                    self._fold()
+                self.shards.append(shard)
+            self.local.shard = shard
+        return shard
+
+    def inc(self, key, n=1):
+        counters = self._shard().counters
+        counters[key] = counters.get(key, 0) + n
+
+    def observe(self, phase, seconds):
+        histograms = self._shard().histograms
+        h = histograms.get(phase)
+        if h is None:
+            h = histograms[phase] = [[0] * (len(self.buckets) + 1), 0.0]
+        h[0][bisect.bisect_left(self.buckets, seconds)] += 1
+        h[1] += seconds
+
+    #func returns a number, or a dict of label value -> number
+    def gauge(self, name, help, func, label=None):
+        self.gauges[name] = (help, func, label)
+
+    @staticmethod
+    def _merge(dst, src):
+        for key, n in list(src.counters.items()):
+            dst.counters[key] = dst.counters.get(key, 0) + n
+        for phase, h in list(src.histograms.items()):
+            t = dst.histograms.get(phase)
+            if t is None:
+                t = dst.histograms[phase] = [[0] * (len(Metrics.buckets) + 1), 0.0]
+            t[0] = [a + b for a, b in zip(t[0], h[0])]
+            t[1] += h[1]
+
+    def _fold(self):
+        alive = []
+        for shard in self.shards:
+            if shard.thread.is_alive():
+                alive.append(shard)
+            else:
+                self._merge(self.retired, shard)
+        self.shards = alive
+
+    def snapshot(self):
+        total = MetricsShard(None)
+        with self.lock:
+            self._fold()
+            self._merge(total, self.retired)
+            for shard in self.shards:
+                self._merge(total, shard)
+        return total
+
+    @staticmethod
+    def _label(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+    #prometheus text exposition format
+    def render(self):
+        total = self.snapshot()
+        counters = total.counters
+        lines = ["# HELP httpd_requests_total Requests served by method and status.",
+                 "# TYPE httpd_requests_total counter"]
+        for key in sorted(k for k in counters if k[0] == "requests"):
+            lines.append('httpd_requests_total{{method="{}",status="{}"}} {}'.format(
+                self._label(key[1]), key[2], counters[key]))
+        for name, key, help in (("httpd_response_bytes_total", ("bytes_sent",), "Response bytes written."),
+                                ("httpd_connections_total", ("connections_opened",), "Connections accepted."),
+                                ("httpd_rejected_total", ("rejected",), "Connections turned away by the overload policy or the per address cap.")):
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} counter".format(name))
+            lines.append("{} {}".format(name, counters.get(key, 0)))
+        cache = sorted(k for k in counters if k[0] == "cache")
+        if cache:
+            lines.append("# HELP httpd_cache_lookups_total Response cache lookups: hit, miss (stored), pass (not cacheable) and error (failed, not stored).")
+            lines.append("# TYPE httpd_cache_lookups_total counter")
+            for key in cache:
+                lines.append('httpd_cache_lookups_total{{result="{}"}} {}'.format(key[1], counters[key]))
+        lines.append("# HELP httpd_connections_active Open client connections.")
+        lines.append("# TYPE httpd_connections_active gauge")
+        lines.append("httpd_connections_active {}".format(
+            counters.get(("connections_opened",), 0) - counters.get(("connections_closed",), 0)))
+        lines.append("# HELP httpd_phase_seconds Request latency by phase: parse, handler, cgi, write.")
+        lines.append("# TYPE httpd_phase_seconds histogram")
+        for phase in sorted(total.histograms):
+            counts, seconds = total.histograms[phase]
+            n = 0
+            for le, count in zip(self.buckets + ("+Inf",), counts):
+                n += count
+                lines.append('httpd_phase_seconds_bucket{{phase="{}",le="{}"}} {}'.format(phase, le, n))
+            lines.append('httpd_phase_seconds_sum{{phase="{}"}} {:.6f}'.format(phase, seconds))
+            lines.append('httpd_phase_seconds_count{{phase="{}"}} {}'.format(phase, n))
+        for name, (help, func, label) in list(self.gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                continue
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} gauge".format(name))
+            if isinstance(value, dict):
+                for k in sorted(value):
+                    lines.append('{}{{{}="{}"}} {}'.format(name, label, self._label(k), value[k]))
+            else:
+                lines.append("{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+#before(phase, info) and after(phase, info, seconds) callbacks around the phases of a
+#request: parse, handler, cgi, error (the error page) and write. info is a dict per request
+#with method, url, addr and status, hooks may keep their own keys in it. Parsing runs before
+#the request is known, so parse hooks get a dict of their own. With no hooks added the
+#phases cost one attribute check
+class RequestHooks:
+    phases = ("parse", "handler", "cgi", "error", "write")
+
+    def __init__(self):
+        self.befores = dict((phase, []) for phase in self.phases)
+        self.afters = dict((phase, []) for phase in self.phases)
+        self.enabled = False
+        self.local = threading.local()
+
+    def add(self, phase, before=None, after=None):
+        if phase not in self.befores:
+            raise ValueError("unknown phase: " + phase)
+        if before:
+            self.befores[phase].append(before)
+        if after:
+            self.afters[phase].append(after)
+        self.enabled = True
+
+    def remove(self, phase, before=None, after=None):
+        if before in self.befores[phase]:
+            self.befores[phase].remove(before)
+        if after in self.afters[phase]:
+            self.afters[phase].remove(after)
+        self.enabled = any(self.befores.values()) or any(self.afters.values())
+
+    #info of the request the current thread is serving
+    def info(self):
+        info = getattr(self.local, "info", None)
+        return {} if info is None else info
+
+    def before(self, phase, info):
+        for func in self.befores[phase]:
+            try:
+                func(phase, info)
+            except Exception as e: # a broken hook must not break the request
+                log.error("hook failed:", phase, func, e)
+
+    def after(self, phase, info, seconds):
+        for func in self.afters[phase]:
+            try:
+                func(phase, info, seconds)
+            except Exception as e:
+                log.error("hook failed:", phase, func, e)
+
+hooks = RequestHooks()
+
+#on-demand profiling, toggled with SIGUSR1. pstats: a sample of the requests runs under
+#cProfile and the merged stats are dumped when profiling stops (python -m pstats FILE).
+#stacks: a thread samples the stacks of all threads every interval and dumps them collapsed,
+#one "frame;frame;frame count" line per stack, the input of flamegraph.pl or speedscope
+class Profiler:
+    modes = ("pstats", "stacks")
+
+    def __init__(self, mode="pstats", sample=0.1, interval=0.005, directory="."):
+        self.mode = mode
+        self.sample = sample
+        self.interval = interval
+        self.directory = directory
+        self.active = False
+        self.lock = threading.Lock()
+        self.profiling = threading.Lock()
+        self.stats = None
+        self.stacks = None
+        self.sampler = None
+
+    def toggle(self, sig=None, frame=None):
+        #called from a signal handler, the work is done in a thread of its own
+        t = threading.Thread(target=self.stop if self.active else self.start, name="httpd-profiler")
+        t.daemon = True
+        t.start()
+
+    def start(self):
+        with self.lock:
+            if self.active:
+                return
+            self.stats = None
+            self.stacks = collections.Counter()
+            self.active = True
+        if self.mode == "stacks":
+            self.sampler = threading.Thread(target=self._sample, name="httpd-sampler")
+            self.sampler.daemon = True
+            self.sampler.start()
+        log.info("profiling started:", self.mode)
+
+    def stop(self):
+        with self.lock:
+            if not self.active:
+                return
+            self.active = False
+        if self.sampler:
+            self.sampler.join()
+            self.sampler = None
+        try:
+            path = self.dump()
+        except OSError as e:
+            log.error("profile not written:", e)
+            return
+        if path:
+            log.info("profile written to:", path)
+        else:
+            log.info("profiling stopped, no request sampled")
+
+    #runs func under cProfile for a sample of the requests. One request at a time, newer
+    #pythons allow only one active profiler per process
+    def run(self, func, *args):
+        if self.mode != "pstats" or random.random() >= self.sample or not self.profiling.acquire(False):
+            return func(*args)
+        prof = cProfile.Profile()
+        try:
+            return prof.runcall(func, *args)
+        finally:
+            self.profiling.release()
+            with self.lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(prof)
+                else:
+                    self.stats.add(prof)
+
+    def _sample(self):
+        me = threading.get_ident()
+        while self.active:
+            #numbers dropped so the threads of one kind share a root frame
+            names = dict((t.ident, "".join(c for c in t.name if not c.isdigit())) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread"))
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def dump(self):
+        path = os.path.join(self.directory, "httpd-{}-{}.{}".format(os.getpid(), time.strftime("%Y%m%d-%H%M%S"), self.mode))
+        with self.lock:
+            if self.mode == "pstats":
+                if self.stats is None:
+                    return None
+                self.stats.dump_stats(path)
+            else:
+                with open(path, "w") as f:
+                    for stack, count in sorted(self.stacks.items()):
+                        f.write("{} {}\n".format(stack, count))
+        return path
+
+profiler = Profiler()
+metrics.gauge("httpd_threads", "Live threads in this process.", threading.active_count)
+
+#concurrent connections per client address, so a few hosts trickling requests can't hold
+#every thread or socket of the server
+class ConnectionLimiter:
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, ip):
+        if max_conns_per_ip <= 0:
+            return True
+        with self.lock:
+            n = self.counts.get(ip, 0)
+            if n >= max_conns_per_ip:
+                return False
+            self.counts[ip] = n + 1
+        return True
+
+    def release(self, ip):
+        with self.lock:
+            n = self.counts.get(ip)
+            if n is None:
+                return
+            if n <= 1:
+                del self.counts[ip]
+            else:
+                self.counts[ip] = n - 1
+
+conn_limits = ConnectionLimiter()
+
+#connections of the threaded engine, a drain closes the idle ones and waits for the rest
+class LiveConnections:
+    def __init__(self):
+        self.readers = set()
+        self.lock = threading.Lock()
+
+    def add(self, reader):
+        with self.lock:
+            self.readers.add(reader)
+
+    def remove(self, reader):
+        with self.lock:
+            self.readers.discard(reader)
+
+    def __len__(self):
+        return len(self.readers)
+
+    #wakes keep-alive connections waiting for their next request, their recv() returns b''.
+    #One whose next request is already in the socket buffer is left to be served, and so is
+    #a new one that hasn't sent its first request yet, the client is about to
+    def closeIdle(self, how=socket.SHUT_RD):
+        with self.lock:
+            readers = list(self.readers)
+        for reader in readers:
+            if how == socket.SHUT_RD:
+                if reader.phase != "idle" or not reader.served or reader.lefts or self._pending(reader.fd):
+                    continue
+            try:
+                reader.fd.shutdown(how)
+            except OSError:
+                pass
+
+    #recv() on these sockets would wait for their timeout, select() just looks
+    @staticmethod
+    def _pending(sock):
+        try:
+            return bool(select.select([sock], [], [], 0)[0])
+        except (OSError, ValueError): # ValueError: fd beyond what select() takes
+            return False
+
+    def closeAll(self):
+        self.closeIdle(socket.SHUT_RDWR)
+
+live_conns = LiveConnections()
+
+#raised by the SIGTERM handler to get the accept loop out of accept()
+class ServerStop(Exception):
+    pass
+
+#the listening socket handed over by the process that restarted us
+def inherited_listener():
+    fd = os.environ.pop("HTTPD_LISTEN_FD", None)
+    if fd is None:
+        return None
+    return socket.socket(fileno=int(fd))
+
+#tells the process that restarted us that we accept connections now
+def notify_ready():
+    fd = os.environ.pop("HTTPD_READY_FD", None)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), b"1")
+        os.close(int(fd))
+    except OSError:
+        pass
+
+#SIGHUP: starts a new server from the script on disk, handing it the listening socket so
+#no connection is refused in between, and drains this one (SIGTERM) once the new one is
+#ready. A new server that fails to come up leaves this one running
+_restarting = threading.Lock()
+def restart(server_sock):
+    if draining or not _restarting.acquire(False):
+        log.warn("restart already in progress")
+        return
+    def run():
+        env = dict(os.environ)
+        fds = []
+        if server_sock is not None:
+            env["HTTPD_LISTEN_FD"] = str(server_sock.fileno())
+            fds.append(server_sock.fileno())
+        ready_r, ready_w = os.pipe()
+        env["HTTPD_READY_FD"] = str(ready_w)
+        fds.append(ready_w)
+        try:
+            proc = subprocess.Popen([sys.executable, httpd_script] + sys.argv[1:], env=env, pass_fds=fds)
+        except OSError as e:
+            log.error("restart failed:", e)
+            _restarting.release()
+            return
+        finally:
+            os.close(ready_w)
+        try:
+            ready = select.select([ready_r], [], [], restart_timeout)[0] and os.read(ready_r, 1)
+        finally:
+            os.close(ready_r)
+        if not ready:
+            log.error("new server {} did not get ready, keep running".format(proc.pid))
+            if proc.poll() is None:
+                proc.kill()
+            _restarting.release()
+            return
+        log.info("new server ready:", proc.pid)
+        os.kill(os.getpid(), signal.SIGTERM)
+    t = threading.Thread(target=run, name="httpd-restart")
+    t.daemon = True
+    t.start()
 
-keepalive_timeout = 10
 class SocketServer:
-    def __init__(self, host, port):
+    def __init__(self, host, port, backlog=128, pool_size=0, queue_size=256, overload="503", reuseport=False):
         self.host = host
         self.port = port
+        self.backlog = backlog
+        self.pool_size = pool_size # 0: one thread per connection
+        self.queue_size = queue_size
+        self.overload = overload
+        self.reuseport = reuseport
+        self.inherited_sock = None # bound by a pre-fork master or the server we replace
+        self.server_sock = None
+        self.stopping = False
+        self.accepting = False
 
-    def start(self, handle_func):
+    def listen(self):
+        if self.inherited_sock:
+            self.server_sock = self.inherited_sock
+            return self.inherited_sock
         server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuseport:
+            server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         try:
             server_sock.bind((self.host, self.port))
-            server_sock.listen(5)
-            print("start server listen on: ", self.host)
-            while True:
-                client_sock, addr = server_sock.accept()
-                t = threading.Thread(target=handle_func, args=(client_sock, addr))
+            server_sock.listen(self.backlog)
+        except:
+            server_sock.close()
+            raise
+        log.info("start server listen on:", self.host, self.port)
+        self.server_sock = server_sock
+        return server_sock
+
+    #SIGTERM: stop accepting, close idle keep-alive connections and let the requests in
+    #flight finish, for at most drain_timeout
+    def drain(self, sig=None, frame=None):
+        global draining
+        log.info("draining:", sig)
+        draining = True
+        self.stopping = True
+        if self.accepting: # the handler runs on the accepting thread, get it out of accept()
+            raise ServerStop()
+
+    def restart(self, sig=None, frame=None):
+        log.info("restarting:", sig)
+        restart(None if self.reuseport else self.server_sock)
+
+    def start(self, handle_func):
+        pool = None
+        server_sock = None
+        try:
+            server_sock = self.listen()
+            if self.pool_size > 0:
+                pool = WorkerPool(handle_func, self.pool_size, self.queue_size, self.overload)
+                pool.start()
+            notify_ready()
+            while not self.stopping:
+                self.accepting = True
+                try:
+                    client_sock, addr = server_sock.accept()
+                finally:
+                    self.accepting = False
+                if pool:
+                    pool.submit(client_sock, addr)
+                else:
+                    t = threading.Thread(target=handle_func, args=(client_sock, addr))
+                    t.start()
+        except ServerStop:
+            pass
+        except OSError as e:
+            log.error("socket error.", e)
+        except Exception as e:
+            log.error("Other exception:", e)
+        finally:
+            if server_sock:
+                server_sock.close()
+            if self.stopping:
+                self._drain(pool)
+            if pool:
+                pool.stop()
+
+    def _drain(self, pool):
+        deadline = time.time() + drain_timeout
+        while len(live_conns) or (pool and pool.queue.qsize()):
+            if time.time() > deadline:
+                log.warn("drain timed out, closing {} connections".format(len(live_conns)))
+                live_conns.closeAll()
+                break
+            live_conns.closeIdle() # also the ones that went idle since the last round
+            time.sleep(0.05)
+        log.info("drained")
+
+#master forks N workers that each run the server on the same port, either accepting on the
+#socket bound here and inherited through fork, or binding their own with SO_REUSEPORT
+class PreforkServer:
+    respawn_delay = 1
+
+    def __init__(self, server, workers):
+        self.server = server
+        self.workers = workers
+        self.children = {}
+        self.running = False
+
+    def start(self, handle_func):
+        if not hasattr(os, "fork"):
+            raise OSError("pre-fork mode needs os.fork")
+        server_sock = None
+        if not self.server.reuseport:
+            server_sock = self.server.listen()
+            self.server.inherited_sock = server_sock
+        self.running = True
+        signal.signal(signal.SIGTERM, self._shutdown)
+        signal.signal(signal.SIGINT, self._shutdown)
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self._forward)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self._restart)
+        try:
+            for i in range(self.workers):
+                self._spawn(handle_func)
+            notify_ready() # the workers accept on the socket bound above, or bind it themselves
+            while self.children:
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+                started = self.children.pop(pid, None)
+                if started is None or not self.running:
+                    continue
+                log.warn("worker {} exited with status {}, restart it".format(pid, status))
+                if time.time() - started < self.respawn_delay: # crash loop, don't fork bomb
+                    time.sleep(self.respawn_delay)
+                if self.running:
+                    self._spawn(handle_func)
+        finally:
+            if server_sock:
+                server_sock.close()
+
+    def _spawn(self, handle_func):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            signal.signal(signal.SIGTERM, self.server.drain)
+            signal.signal(signal.SIGINT, quit)
+            if hasattr(signal, "SIGUSR1"):
+                signal.signal(signal.SIGUSR1, profiler.toggle)
+            if hasattr(signal, "SIGHUP"): # restarts are the master's business
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            try:
+                self.server.start(handle_func)
+            except SystemExit:
+                pass
+            except BaseException as e:
+                log.error("worker exception:", e)
+                code = 1
+            finally:
+                log.close()
+                os._exit(code)
+        self.children[pid] = time.time()
+        log.info("worker started:", pid)
+
+    #the master serves nothing, signals like SIGUSR1 (profiling) are meant for the workers
+    def _forward(self, sig, frame):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+
+    #a SIGTERM drains the workers, SIGINT stops them right away
+    def _shutdown(self, sig, frame):
+        log.info("You stop me:", sig)
+        self.running = False
+        if self.server.inherited_sock: # the listener goes away once the workers close theirs too
+            self.server.inherited_sock.close()
+        for pid in list(self.children):
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+
+    def _restart(self, sig, frame):
+        log.info("restarting:", sig)
+        restart(None if self.server.reuseport else self.server.inherited_sock)
+
+#fixed number of threads fed by the accept queue, thread count stays flat under a burst
+class WorkerPool:
+    overload_policies = ("503", "refuse")
+
+    def __init__(self, handle_func, size, queue_size, overload="503"):
+        if overload not in self.overload_policies:
+            raise ValueError("unknown overload policy: " + overload)
+        self.handle_func = handle_func
+        self.size = size
+        self.overload = overload
+        self.queue = queue.Queue(queue_size)
+        self.threads = []
+        self.rejected = 0
+
+    def start(self):
+        metrics.gauge("httpd_queue_depth", "Work waiting for a thread.", lambda: {"accept": self.queue.qsize()}, "queue")
+        metrics.gauge("httpd_worker_threads", "Threads serving connections.", lambda: len(self.threads))
+        for i in range(self.size):
+            t = threading.Thread(target=self._work, name="httpd-worker-%d" % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        self.threads = []
+
+    def submit(self, client_sock, addr):
+        try:
+            self.queue.put_nowait((client_sock, addr))
+        except queue.Full:
+            self.rejected += 1
+            metrics.inc(("rejected",))
+            self._reject(client_sock)
+
+    def _reject(self, client_sock):
+        try:
+            if self.overload == "503":
+                # never block the accept loop on a slow client
+                client_sock.setblocking(False)
+                client_sock.send(canned_response(503))
+            else:
+                # RST instead of FIN, the client sees a refused connection at once
+                client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        except OSError:
+            pass
+        finally:
+            client_sock.close()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.handle_func(*item)
+            except Exception as e:
+                log.error("worker exception:", e)
+
+#single thread drives every socket with selectors, only handler() runs on the pool threads
+#so idle keep-alive and slow clients cost a buffer instead of a thread
+class EventLoopServer(SocketServer):
+    recvsize = 65536
+    sweep_interval = 1
+    sendmsg = hasattr(socket.socket, "sendmsg")
+    max_iov = 64
+
+    def start(self, serve_func):
+        self.serve_func = serve_func
+        self.recvbuf = memoryview(bytearray(self.recvsize)) # only the loop thread reads
+        self.selector = selectors.DefaultSelector()
+        self.conns = set()
+        self.jobs = queue.Queue()
+        self.done = collections.deque()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        server_sock = None
+        threads = []
+        try:
+            server_sock = self.listen()
+            server_sock.setblocking(False)
+            self.selector.register(server_sock, selectors.EVENT_READ, None)
+            self.selector.register(self.wake_r, selectors.EVENT_READ, self.wake_r)
+            metrics.gauge("httpd_queue_depth", "Work waiting for a thread.", lambda: {"handler": self.jobs.qsize()}, "queue")
+            metrics.gauge("httpd_worker_threads", "Threads serving connections.", lambda: len(threads))
+            for i in range(self.pool_size or 4):
+                t = threading.Thread(target=self._work, name="httpd-handler-%d" % i)
+                t.daemon = True
                 t.start()
+                threads.append(t)
+            notify_ready()
+            lastsweep = time.time()
+            deadline = None
+            while True:
+                if self.stopping:
+                    if deadline is None:
+                        deadline = time.time() + drain_timeout
+                        self.selector.unregister(server_sock)
+                        server_sock.close()
+                        server_sock = None
+                    self._closeIdle()
+                    if not self.conns:
+                        log.info("drained")
+                        break
+                    if time.time() > deadline:
+                        log.warn("drain timed out, closing {} connections".format(len(self.conns)))
+                        break
+                for key, mask in self.selector.select(0.05 if self.stopping else self.sweep_interval):
+                    if key.data is None:
+                        self._accept(key.fileobj)
+                    elif key.data is self.wake_r:
+                        self._finish()
+                    else:
+                        self._io(key.data, mask)
+                now = time.time()
+                if now - lastsweep >= self.sweep_interval:
+                    lastsweep = now
+                    self._sweep(now)
         except OSError as e:
-            print("socket error.", e)
+            log.error("socket error.", e)
         except Exception as e:
-            print("Other exception: ", e)
+            log.error("Other exception:", e)
         finally:
-            server_sock.close()
+            for _ in threads:
+                self.jobs.put(None)
+            for conn in list(self.conns):
+                self._close(conn)
+            if server_sock:
+                server_sock.close()
+            self.selector.close()
+            self.wake_r.close()
+            self.wake_w.close()
+
+    #the handler runs on the loop thread, the loop does the rest once select() returns
+    def drain(self, sig=None, frame=None):
+        global draining
+        log.info("draining:", sig)
+        draining = True
+        self.stopping = True
+        wake_w = getattr(self, "wake_w", None)
+        if wake_w:
+            try:
+                wake_w.send(b'\0')
+            except OSError:
+                pass
+
+    #keep-alive connections between two requests, nothing in flight on them. One whose next
+    #request is already in the socket buffer is left to be served, and so is a new one that
+    #hasn't sent its first request yet
+    def _closeIdle(self):
+        for conn in list(self.conns):
+            if conn.served and not conn.busy and not conn.outq and conn.body is None and conn.parser.started is None:
+                try:
+                    if conn.sock.recv(1, socket.MSG_PEEK):
+                        continue
+                except (BlockingIOError, InterruptedError):
+                    pass
+                except OSError:
+                    pass
+                self._close(conn)
+
+    def _accept(self, server_sock):
+        while True:
+            try:
+                client_sock, addr = server_sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e: # EMFILE etc., retry on the next readiness event
+                log.warn("accept error.", e)
+                return
+            if not conn_limits.acquire(addr[0]):
+                metrics.inc(("rejected",))
+                refuse(client_sock, 429)
+                continue
+            client_sock.setblocking(False)
+            conn = LoopConnection(client_sock, addr)
+            self.conns.add(conn)
+            metrics.inc(("connections_opened",))
+            self.selector.register(client_sock, selectors.EVENT_READ, conn)
+
+    def _io(self, conn, mask):
+        if mask & selectors.EVENT_READ:
+            try:
+                n = conn.sock.recv_into(self.recvbuf)
+            except (BlockingIOError, InterruptedError):
+                n = None
+            except OSError:
+                n = 0
+            if n == 0:
+                self._close(conn)
+                return
+            if n:
+                conn.last_active = time.time()
+                conn.reader.feed(self.recvbuf[:n]) # copied into the connection's buffer
+                if conn.busy and conn.reader.pending() > conn.reader.limit:
+                    conn.paused = True # pipelined too far ahead, read again once the response is out
+                    self._watch(conn, selectors.EVENT_WRITE if conn.outq else 0)
+                    return
+                self._process(conn)
+        if mask & selectors.EVENT_WRITE:
+            self._flush(conn)
+
+    def _process(self, conn):
+        if conn.busy or conn.closing or conn.sock is None:
+            return
+        parser = conn.parser
+        try:
+            if not parser.done:
+                HttpHandler.parseHead(conn.reader, parser)
+                conn.reader.commit()
+                status, body = HttpHandler.checkHead(parser)
+                if status != HttpHandler.INTERNAL_OK:
+                    self._dispatch(conn, (status, parser.url, parser.method, parser.version, parser.headers, body))
+                    return
+                conn.body = body
+                conn.body_started = time.time()
+                if not body.collect(parser.lefts):
+                    if body.expect:
+                        body.expect = False
+                        conn.outq.append(HttpHandler.continue_line)
+                        self._flush(conn)
+                    return
+            elif conn.body is None or conn.reader.pending() == 0:
+                return
+            elif not conn.body.feed(conn.reader.take()):
+                return
+        except NeedMoreData:
+            conn.reader.commit() # consumed bytes live in the parser now
+            if conn.reader.pending() > conn.reader.limit:
+                self._close(conn)
+            return
+        except HttpError as e:
+            conn.reader.commit()
+            if conn.body:
+                conn.body.close()
+            self._dispatch(conn, (e.status, parser.url, parser.method, parser.version or 1.0, parser.headers or Headers(), RequestBody.empty()))
+            return
+        except Exception as e:
+            log.debug("bad request from:", conn.addr, e)
+            self._close(conn)
+            return
+        body = conn.body
+        if body.decoder.lefts is not None:
+            conn.reader.unread(body.decoder.lefts)
+        body.spool.rewind()
+        self._dispatch(conn, (HttpHandler.INTERNAL_OK, parser.url, parser.method, parser.version, parser.headers, body))
+
+    def _dispatch(self, conn, parsed):
+        conn.parser = RequestParser()
+        conn.body = None
+        conn.served += 1
+        conn.busy = True
+        self.jobs.put((conn, parsed))
+
+    def _work(self):
+        while True:
+            item = self.jobs.get()
+            if item is None:
+                break
+            conn, parsed = item
+            writer = LoopWriter(self, conn)
+            try:
+                keepalive = self.serve_func(parsed, writer, conn.served, conn.addr)
+            except ConnectionError: # response aborted, already logged
+                keepalive = False
+            except Exception as e:
+                log.error("handler exception:", e)
+                keepalive = False
+            self.post(conn, writer.items, keepalive)
+
+    #hand response bytes over to the loop thread, keepalive None means more will follow
+    def post(self, conn, items, keepalive):
+        self.done.append((conn, items, keepalive))
+        try:
+            self.wake_w.send(b'\0')
+        except BlockingIOError: # loop is already signalled
+            pass
+
+    def _finish(self):
+        try:
+            while self.wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.done:
+            conn, items, keepalive = self.done.popleft()
+            if keepalive is not None:
+                conn.busy = False
+            if conn.sock is None:
+                BufferWriter.discard(items)
+                conn.drained.set()
+                continue
+            conn.outq.extend(items)
+            if keepalive is not None:
+                conn.closing = not keepalive
+            conn.last_active = time.time()
+            self._flush(conn)
+
+    def _flush(self, conn):
+        outq = conn.outq
+        sent = False
+        while outq:
+            item = outq[0]
+            try:
+                if isinstance(item, FileSegment):
+                    n = item.send(conn.sock)
+                    if n == 0: # file shrank under us, the response can't be completed
+                        self._close(conn)
+                        return
+                    sent = True
+                    if item.count > 0:
+                        continue
+                    item.file.close()
+                elif len(outq) > 1 and self.sendmsg:
+                    self._sendv(conn, outq)
+                    sent = True
+                    continue
+                else:
+                    n = conn.sock.send(item)
+                    sent = True
+                    if n < len(item):
+                        outq[0] = memoryview(item)[n:]
+                        continue
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self._close(conn)
+                return
+            outq.popleft()
+        if sent: # write deadline counts from the last progress
+            conn.last_active = time.time()
+        if not outq:
+            conn.drained.set()
+        if outq:
+            self._watch(conn, selectors.EVENT_WRITE)
+        elif conn.closing:
+            self._close(conn)
+        else:
+            conn.paused = False
+            self._watch(conn, 0)
+            self._process(conn) # pipelined request already buffered
+
+    #EVENT_READ is added unless reading is paused, a connection waiting for nothing is unregistered
+    def _watch(self, conn, events):
+        if not conn.paused:
+            events |= selectors.EVENT_READ
+        if events == conn.events:
+            return
+        if not events:
+            self.selector.unregister(conn.sock)
+        elif not conn.events:
+            self.selector.register(conn.sock, events, conn)
+        else:
+            self.selector.modify(conn.sock, events, conn)
+        conn.events = events
+
+    #one sendmsg for the leading buffers of the queue, up to the next file segment
+    def _sendv(self, conn, outq):
+        views = []
+        for item in outq:
+            if isinstance(item, FileSegment) or len(views) == self.max_iov:
+                break
+            views.append(item)
+        n = conn.sock.sendmsg(views)
+        while n:
+            item = outq[0]
+            if n >= len(item):
+                n -= len(item)
+                outq.popleft()
+            else:
+                outq[0] = memoryview(item)[n:]
+                n = 0
+
+    #deadlines of the loop engine: a response the client stopped reading, a stalled body
+    #or head (answered with 408) and an idle keep-alive connection
+    def _sweep(self, now):
+        for conn in list(self.conns):
+            if conn.outq:
+                if now - conn.last_active > write_timeout:
+                    self._close(conn)
+            elif conn.busy or conn.closing:
+                continue
+            elif conn.body is not None:
+                elapsed = now - conn.body_started
+                if now - conn.last_active > body_timeout or \
+                        (elapsed > body_timeout and conn.body.received < elapsed * body_min_rate):
+                    self._timeout(conn)
+            elif conn.parser.started is not None:
+                if now - conn.parser.started > header_timeout:
+                    self._timeout(conn)
+            elif now - conn.last_active > keepalive_timeout:
+                self._close(conn)
+
+    def _timeout(self, conn):
+        log.debug("request timed out:", conn.addr)
+        parser = conn.parser
+        if conn.body:
+            conn.body.close()
+        self._dispatch(conn, (408, parser.url, parser.method, parser.version or 1.0, parser.headers or Headers(), RequestBody.empty()))
+
+    def _close(self, conn):
+        if conn.sock is None:
+            return
+        self.conns.discard(conn)
+        conn_limits.release(conn.addr[0])
+        metrics.inc(("connections_closed",))
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+        conn.sock = None
+        conn.drained.set()
+        if conn.body:
+            conn.body.close()
+        BufferWriter.discard(conn.outq)
+        conn.outq.clear()
+
+class LoopConnection:
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.reader = BufferReader()
+        self.parser = RequestParser()
+        self.body = None
+        self.body_started = 0
+        self.outq = collections.deque()
+        self.drained = threading.Event() # set while outq is empty, streaming handlers wait on it
+        self.drained.set()
+        self.served = 0
+        self.busy = False
+        self.closing = False
+        self.paused = False # reading stopped, see _io
+        self.events = selectors.EVENT_READ # what the selector watches for
+        self.last_active = time.time()
 
 class HttpHandler:
-    readsize = 128
-    implement_methods = ("GET", "POST")
-    bodylimits = 8192 #8k
+    readsize = 65536
+    implement_methods = ("GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS")
+    bodylimits = 64 * 1024 * 1024 #64M, larger bodies get 413
+    spoolsize = 1024 * 1024 #bodies above this are spooled to a temporary file
+    continue_line = b"HTTP/1.1 100 Continue\r\n\r\n"
+    digits = frozenset("0123456789")
     INTERNAL_OK = 0
     http_status_msg = {
         100: "Continue",
@@ -75,6 +1258,8 @@ class HttpHandler:
         415: "Unsupported Media Type",
         416: "Requested range not satisfiable",
         417: "Expectation Failed",
+        429: "Too Many Requests",
+        431: "Request Header Fields Too Large",
         500: "Internal Server Error",
         501: "Method Not Implemented",
         502: "Bad Gateway",
@@ -84,219 +1269,2812 @@ class HttpHandler:
     }
 
     @staticmethod
-    def _parseHeader(readfunc):
-        array = bytearray()
-    #    buffer = memoryview(array)
-        while True:
+    def parseHead(readfunc, parser):
+        while not parser.done:
             readbytes = readfunc()
-            sz1 = len(array)
-            array[sz1:] = readbytes
-            e = array.find(b'\r\n\r\n', -len(readbytes)-3)
-            if e > 0:
-                partbody = array[e+4:]
-                break
-        print("Raw bytes: ", array)
-        headerlines = array.split(b'\r\n')
-        headers = {}
-        for i in range(1, len(headerlines)):
-            line = headerlines[i]
-            if line == b'':
-                break
-            strline = line.decode()
-            m = re.split(r':\s*', strline, 1)
-            if len(m) == 2:
-                headers[m[0]] = m[1]
-            else:
-                print("wrong header line: ", strline)
+            if not readbytes:
+                if parser.empty(): # client closed the connection between requests
+                    return False
+                raise ConnectionError("connection closed while reading header")
+            parser.feed(readbytes)
+        return True
 
-        return headerlines[0].decode(), headers, partbody
-
-    @staticmethod
-    def _parseIdentity(cls, readfunc, headers, partbody):
-        print("parse identity")
-        length = headers.get("Content-Length", None)
-        body = b''
-        if length:
-            length = int(length)
-            if length > cls.bodylimits:
-                return 413
-            partlen = len(partbody)
-            if partlen >= length:
-                body = bytes(partbody[0:length])  # bytes array
+    #validates the head and sets up the body decoder, returns (status, RequestBody)
+    @classmethod
+    def checkHead(cls, parser):
+        method, ver, headers = parser.method, parser.version, parser.headers
+        if ver > 1.1 or ver < 1.0:
+            return 505, RequestBody.empty()
+        if method not in cls.implement_methods:
+            return 501, RequestBody.empty()
+        mode = headers.get("Transfer-Encoding", None)
+        if mode:
+            if "Content-Length" in headers: # framed two ways, a proxy may pick the other one
+                return 400, RequestBody.empty()
+            mode = mode.lower()
+            if mode != "identity" and mode != "chunked":
+                return 501, RequestBody.empty()
+        if mode == "chunked":
+            decoder = BodyDecoder(chunked=True)
+        else: #identity
+            length = headers.get("Content-Length", None)
+            if length is None:
+                length = 0
+            elif not length or not cls.digits.issuperset(length): # int() would take "+5", " 5" or "1_0"
+                return 400, RequestBody.empty()
             else:
-                lefts = readfunc(length - partlen)
-                body = b''.join((partbody, lefts))
+                length = int(length)
+            if length > cls.bodylimits:
+                return 413, RequestBody.empty()
+            decoder = BodyDecoder(length)
+        expect = headers.get("Expect", None)
+        if expect:
+            if expect.lower() != "100-continue":
+                return 417, RequestBody.empty()
+            # only owed when the client is actually waiting for it
+            expect = ver >= 1.1 and not decoder.done and not parser.lefts
+        body = RequestBody(decoder, expect)
+        body.content_type = headers.get("Content-Type", "")
         return 0, body
 
-    @staticmethod
-    def _parseOneChunk(readfunc, body):
-        print("parse chunked")
-        sep = b'\r\n'
-        while True:
-            s = body.find(sep)
-            if s > 0:
-                sz = int(body[0:s-1], 16)
-                lefts = body[s+len(sep):]
-                return sz, lefts
-            else:
-                print("watch if loop always in here")
-                newbytes = readfunc()
-                for b in newbytes:
-                    body.append(b)
+    @classmethod
+    def parseBody(cls, readfunc, parser, writefunc=None):
+        method, url, ver, headers = parser.method, parser.url, parser.version, parser.headers
+        code, body = cls.checkHead(parser)
+        if code == cls.INTERNAL_OK:
+            try:
+                body.stream(readfunc, writefunc, parser.lefts) # the head's packet may carry a bad chunk already
+            except HttpError as e:
+                body.close()
+                return e.status, url, method, ver, headers, RequestBody.empty()
+        return code, url, method, ver, headers, body
 
-    @staticmethod
-    def _parseChunked(cls, readfunc, partbody):
-        sizeall = 0
-        body = partbody
-        result = memoryview(bytearray(cls.bodylimits))
-        while True:
-            sz, body = cls._parseOneChunk(readfunc, body)
-            if sz == 0:
-                break
-            sizeall += sz
-            if sizeall > cls.bodylimits:
+    @classmethod
+    def parse(cls, readfunc, writefunc=None):
+        parser = RequestParser()
+        try:
+            if not cls.parseHead(readfunc, parser):
                 return None
-            if len(body) >= sz:
-                print("body larger than sz, next chunked data?")
-                result[sizeall-sz:] = body[0:sz]
-                body = body[sz:]
-            else:
-                result[sizeall-sz:] = b''.join(body, readfunc(sz-len(body)))
-                body = b''
-        ret = result[0:sizeall].tobytes()
-        result.release()
-        return 0, ret
-
-    # 当客户端向服务器请求一个静态页面或者一张图片时，服务器可以很清楚的知道内容大小，然后通过Content - length消息首部字段告诉客户端
-    # 需要接收多少数据。但是如果是动态页面等时，服务器是不可能预先知道内容大小，这时就可以使用Transfer - Encoding：chunk模式来传输
-    # 数据了。即如果要一边产生数据，一边发给客户端，服务器就需要使用
-    # "Transfer-Encoding: chunked"
-    # 这样的方式来代替Content - Length
-    # chunk编码将数据分成一块一块的发生。Chunked编码将使用若干个Chunk串连而成，由一个标明长度为0
-    # 的chunk标示结束。每个Chunk分为头部和正文两部分，头部内容指定正文的字符总数（十六进制的数字 ）和数量单位（一般不写），正文部分就是指定长度的实际内容，两部分之间用回车换行(CRLF)
-    # 隔开。在最后一个长度为0的Chunk中的内容是称为footer的内容，是一些附加的Header信息（通常可以直接忽略）。 Chunk编码的格式如下：
+        except HttpError as e:
+            return e.status, None, None, 1.0, Headers(), RequestBody.empty()
+        return cls.parseBody(readfunc, parser, writefunc)
 
-    @classmethod
-    def parse(cls, readfunc):
-        requestline, headers, partbody = cls._parseHeader(readfunc)
-        #request line GET /abc HTTP/1.1
-        print("requestline: ", requestline)
-        m = re.match(r"^(\w+)\s+(.*?)\s+HTTP/(\d.\d)$", requestline)
-        if m:
-            method, url, ver = m.groups()
-            ver = float(ver)
-            if ver > 1.1 or ver < 1.0:
-                return 505
-            if method not in cls.implement_methods:
-                return 501
-            mode = headers.get("Transfer-Encoding", None)
-            if mode:
-                if mode != "identity" and mode != "chunked":
-                    return 501
-            if mode == "chunked":
-                code, body = HttpHandler._parseChunked(HttpHandler, readfunc, partbody)
-            else: #identity
-                code, body = HttpHandler._parseIdentity(HttpHandler, readfunc, headers, partbody)
-        return code, url, method, headers, body
+    # HTTP/1.1 默认长连接，除非 Connection: close；HTTP/1.0 默认短连接，除非 Connection: keep-alive
+    @staticmethod
+    def keepalive(ver, headers):
+        conn = headers.get("Connection", "").lower()
+        if ver >= 1.1:
+            return "close" not in conn
+        return "keep-alive" in conn
 
     @classmethod
     def response(cls, writefunc, status, contents, headers=None):
-        response_line = "HTTP/1.1 {:03d} {}\r\n".format(status, cls.http_status_msg[status])
-        writefunc(response_line.encode())
-        if headers and len(headers) > 0:
-            for di in headers.items():
-                header_line = str.format("{}: {}", di[0], di[1])
-                writefunc(header_line.encode())
-        if contents:
-            writefunc(("Content-Length: %d\r\n\r\n" % len(contents)).encode())
-            writefunc(contents)
-        else:
-            writefunc(b'\r\n')
+        #status line and headers are built into one buffer and go out with the start of the
+        #body, so a small response is a single segment
+        lines = ["HTTP/1.1 {:03d} {}\r\n".format(status, cls.http_status_msg.get(status, ""))]
+        if headers:
+            for name, value in headers.items():
+                if isinstance(value, list): # repeated header like Set-Cookie
+                    for v in value:
+                        lines.append("{}: {}\r\n".format(name, v))
+                else:
+                    lines.append("{}: {}\r\n".format(name, value))
+        head = "".join(lines).encode()
+        if isinstance(contents, StaticFile):
+            if status == 304: # validators only, no body
+                writefunc(head + contents.validators + b"\r\n")
+                return
+            contents.write(writefunc, head=head + contents.header)
+            return
+        if isinstance(contents, StaticRange):
+            head += contents.header
+            for prefix, start, length in contents.parts:
+                contents.entry.write(writefunc, start, length, head + prefix if prefix else head)
+                head = b''
+            if contents.trailer:
+                writefunc(contents.trailer)
+            return
+        if status == 204 or status == 304: # never a body, nor a length for one
+            close = getattr(contents, "close", None)
+            if close:
+                close()
+            writefunc(head + b"\r\n")
+            return
+        if is_stream(contents):
+            cls._writeChunked(writefunc, contents, head)
+            return
+        # 长连接下必须明确 body 长度，否则客户端无法判断响应的结束
+        contents = contents or b''
+        writefunc.writev((head, b"Content-Length: %d\r\n\r\n" % len(contents), contents))
+
+    # body of unknown length: every piece goes out as a chunk as soon as it is produced
+    @staticmethod
+    def _writeChunked(writefunc, contents, head):
+        flush = getattr(writefunc, "flush", None)
+        head += b"Transfer-Encoding: chunked\r\n\r\n"
+        try:
+            for datas in contents:
+                if datas:
+                    writefunc.writev((head + b"%x\r\n" % len(datas), datas, b"\r\n"))
+                    head = b''
+                    if flush:
+                        flush()
+            writefunc(head + b"0\r\n\r\n")
+        finally:
+            close = getattr(contents, "close", None)
+            if close:
+                close()
 
     @staticmethod
     def write_func(fd):
-        return lambda stream: fd.send(stream)
+        return SocketWriter(fd)
 
     @classmethod
     def read_func(cls, fd):
-        return lambda size=cls.readsize: fd.recv(size)
+        return SocketReader(fd, cls.readsize)
 
-def read_filebytes(file):
-    with open(file, "rb") as f:
-        datas = f.read()
-    return datas
-def errorhtml(status, headers):
-    file = "htdocs/error.html"
-    with open(file, "rb") as f:
-        datas = f.read()
-        datas = datas.replace(b"[status]", str(status).encode())
-        datas = datas.replace(b"[errormsg]", HttpHandler.http_status_msg[status].encode())
-        headers["Content-Type"] = "text/html\r\n"
-        return datas
+#bytes read beyond the current request are pushed back and served to the next one on the connection
+#every recv gets the time left in the current phase as socket timeout: idle until the first
+#byte of a request (keepalive_timeout), then the whole head (header_timeout), then the body
+#with a limit on pauses and on the average rate. A phase running out raises socket.timeout
+class SocketReader:
+    def __init__(self, fd, readsize):
+        self.fd = fd
+        self.readsize = readsize
+        self.lefts = b''
+        self.served = 0 # requests read so far on the connection
+        self.buf = recv_buffers.get(readsize)
+        self.view = memoryview(self.buf)
+        self.expect("idle", keepalive_timeout)
 
-#simply handle get, return url asset. post, cgi call
-def handler(url, method, headers, body, response_headers):
-    up = urlparse(url)
-    datas = b""
-    if up.path:
-        path = up.path
-        if method == "GET":
-            contenttype = headers.get("Content-Type", None)
-            if contenttype and "text/html" in contenttype or path.endswith(".html"):
-                response_headers["Content-Type"] = "text/html;charset=utf-8\r\n"
-                try:
-                    f = open("htdocs/" + path, "rb")
-                    datas = f.read()
-                except FileNotFoundError:
-                    return 404, datas
-                finally:
-                    f.close()
-            else:
-                return 400, datas
-        elif method == "POST": # 是否执行cgi 其实与请求方法无关
-            os.environ["QUERY_STRING"] = up.query
-            cgi = "htdocs" + up.path
-            if not os.path.isfile(cgi):
-                return 400, datas
-        #    r, w = os.pipe()
-        #    os.write(r, body)
-            p=subprocess.Popen(["python",cgi], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-            #p.stdin.write(body)
-            datas, errs = p.communicate(input=body)
-            del os.environ["QUERY_STRING"]
-
-    return 200, datas
+    def close(self):
+        if self.buf is not None:
+            self.view.release()
+            recv_buffers.put(self.buf)
+            self.buf = self.view = None
 
-def handle_socket(client_sock, addr):
-    print("new sock from: ", addr, client_sock)
-    read_func = HttpHandler.read_func(client_sock)
-    status, url, method, headers, body = HttpHandler.parse(read_func)
-    if url == "/favicon.ico":
+    def expect(self, phase, timeout=None):
+        self.phase = phase
+        self.started = time.time()
+        self.deadline = self.started + timeout if timeout else None
+        self.received = 0
+
+    def __call__(self, size=None):
+        size = size or self.readsize
+        if self.lefts:
+            readbytes = self.lefts[:size]
+            self.lefts = self.lefts[size:]
+            if self.phase == "idle":
+                self.expect("header", header_timeout)
+            return readbytes
+        now = time.time()
+        if self.phase == "body":
+            elapsed = now - self.started
+            if elapsed > body_timeout and self.received < elapsed * body_min_rate:
+                raise socket.timeout("request body too slow")
+            timeout = body_timeout
+        else:
+            timeout = self.deadline - now
+            if timeout <= 0:
+                raise socket.timeout(self.phase + " timed out")
+        self.fd.settimeout(timeout)
+        n = self.fd.recv_into(self.view, min(size, len(self.buf)))
+        readbytes = bytes(self.view[:n]) # the buffer is reused, callers get their own copy of n bytes
+        self.received += n
+        if self.phase == "idle" and readbytes:
+            self.expect("header", header_timeout)
+        return readbytes
+
+    def unread(self, readbytes):
+        if self.lefts:
+            self.lefts = bytes(readbytes) + bytes(self.lefts)
+        else:
+            self.lefts = readbytes # usually a memoryview into the parser buffer, no copy
+
+#writers take ownership of the file handed to sendfile() and close it once it is sent
+#more=True tells the kernel more data follows right away (MSG_MORE), so a header written
+#before a sendfile() body doesn't go out as a segment of its own
+class SocketWriter:
+    msg_more = getattr(socket, "MSG_MORE", 0)
+    small = 4096
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.sent = 0
+
+    def __call__(self, stream, more=False):
+        self.fd.settimeout(write_timeout)
+        self.fd.sendall(stream, self.msg_more if more else 0)
+        self.sent += len(stream)
+
+    #gathered write of several buffers with sendmsg, small ones are simply joined
+    def writev(self, buffers):
+        buffers = [b for b in buffers if b]
+        total = sum(len(b) for b in buffers)
+        self.sent += total
+        self.fd.settimeout(write_timeout)
+        if total <= self.small or len(buffers) == 1 or not hasattr(self.fd, "sendmsg"):
+            self.fd.sendall(b''.join(buffers) if len(buffers) > 1 else buffers[0] if buffers else b'')
+            return
+        views = [memoryview(b) for b in buffers]
+        while views:
+            n = self.fd.sendmsg(views)
+            while n:
+                if n >= len(views[0]):
+                    n -= len(views.pop(0))
+                else:
+                    views[0] = views[0][n:]
+                    n = 0
+
+    def sendfile(self, file, offset, count):
         try:
-            datas = read_filebytes("htdocs" + url)
-            HttpHandler.response(HttpHandler.write_func(client_sock), 200, datas)
-        except FileNotFoundError:
-            pass
+            self.fd.settimeout(write_timeout)
+            self.sent += self.fd.sendfile(file, offset, count)
         finally:
-            client_sock.close()
-      #  HttpHandler.response(HttpHandler.write_func(client_sock), 404, b"")
-        return
-    print("http request status: {}, url: {}, method: {}, body: {}".format(status, url, method, body))
+            file.close()
 
-    response_headers = {}
-    if status == HttpHandler.INTERNAL_OK: #continue proceed
-        status, datas = handler(url, method, headers, body, response_headers)
-    if status != 200:
-        datas = errorhtml(status, response_headers)
-    HttpHandler.response(HttpHandler.write_func(client_sock), status, datas, response_headers)
-    client_sock.close()
+#collects a response for the event loop, which writes it out when the socket is writable
+class BufferWriter:
+    def __init__(self):
+        self.items = []
+        self.sent = 0 # queued, the loop may still fail to deliver it
 
-def quit(sig, frame):
-    print("You stop me: ", sig)
-    sys.exit()
+    def __call__(self, stream, more=False):
+        items = self.items
+        self.sent += len(stream)
+        if len(stream) >= 4096: # big bodies are queued as they are
+            items.append(stream)
+        elif items and type(items[-1]) is bytearray: # coalesce small writes
+            items[-1] += stream
+        else:
+            items.append(bytearray(stream))
+
+    def writev(self, buffers):
+        for stream in buffers:
+            if stream:
+                self(stream)
+
+    def sendfile(self, file, offset, count):
+        self.items.append(FileSegment(file, offset, count))
+        self.sent += count
+
+    @staticmethod
+    def discard(items):
+        for item in items:
+            if isinstance(item, FileSegment):
+                item.file.close()
+
+#event loop writer for streamed responses: flush() passes what is buffered so far to the loop
+#and blocks the handler thread until the socket took it, so a fast producer can't outrun a slow client
+class LoopWriter(BufferWriter):
+    def __init__(self, server, conn):
+        BufferWriter.__init__(self)
+        self.server = server
+        self.conn = conn
+
+    def flush(self):
+        if not self.items:
+            return
+        conn = self.conn
+        conn.drained.clear()
+        self.server.post(conn, self.items, None)
+        self.items = []
+        if not conn.drained.wait(write_timeout) or conn.sock is None:
+            raise ConnectionError("client stopped reading")
+
+class FileSegment:
+    def __init__(self, file, offset, count):
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+    def send(self, sock):
+        if hasattr(os, "sendfile"):
+            n = os.sendfile(sock.fileno(), self.file.fileno(), self.offset, min(self.count, 1 << 20))
+        else:
+            self.file.seek(self.offset)
+            datas = self.file.read(min(self.count, 65536))
+            n = sock.send(datas) if datas else 0
+        self.offset += n
+        self.count -= n
+        return n
+
+class HttpError(Exception):
+    def __init__(self, status, msg=None):
+        Exception.__init__(self, msg or HttpHandler.http_status_msg[status])
+        self.status = status
+
+#header names are matched case-insensitively, stored lower-cased
+class Headers(dict):
+    def __setitem__(self, name, value):
+        dict.__setitem__(self, name.lower(), value)
+
+    def __getitem__(self, name):
+        return dict.__getitem__(self, name.lower())
+
+    def __delitem__(self, name):
+        dict.__delitem__(self, name.lower())
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name.lower())
+
+    def get(self, name, default=None):
+        return dict.get(self, name.lower(), default)
+
+#incremental request head parser: feed() it whatever recv returned, it only rescans the
+#new bytes for the blank line and splits the head once it is complete.
+#lefts is a memoryview of the bytes after the head (body or the next pipelined request)
+class RequestParser:
+    max_header_size = 16384
+    max_headers = 100
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.done = False
+        self.method = None
+        self.url = None
+        self.version = None
+        self.headers = None
+        self.lefts = None
+        self.started = None
+        self.info = None
+
+    def empty(self):
+        return not self.buf
+
+    def feed(self, readbytes):
+        if self.started is None: # parse time counts from the first byte, not the keep-alive wait
+            self.started = time.time()
+            if hooks.enabled:
+                self.info = {}
+                hooks.before("parse", self.info)
+        buf = self.buf
+        start = len(buf) - 3 if len(buf) > 3 else 0
+        buf += readbytes
+        e = buf.find(b'\r\n\r\n', start)
+        if e < 0:
+            if len(buf) > self.max_header_size:
+                raise HttpError(431)
+            return False
+        if e > self.max_header_size:
+            raise HttpError(431)
+        self._parseHead(buf[:e].decode("latin-1"))
+        self.lefts = memoryview(buf)[e+4:]
+        self.done = True
+        seconds = time.time() - self.started
+        metrics.observe("parse", seconds)
+        if self.info is not None:
+            self.info["method"], self.info["url"] = self.method, self.url
+            hooks.after("parse", self.info, seconds)
+        return True
+
+    def _parseHead(self, head):
+        lines = head.lstrip("\r\n").split("\r\n")
+        if len(lines) > self.max_headers + 1:
+            raise HttpError(431)
+        #request line GET /abc HTTP/1.1
+        parts = lines[0].split()
+        if len(parts) != 3 or not self.valid_version(parts[2]):
+            raise HttpError(400, "bad request line")
+        self.version = float(parts[2][5:]) # only 1.0 and 1.1 get past checkHead, others 505
+        self.method, self.url = parts[0], parts[1]
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if not sep or not name or name[0] in " \t" or name[-1] in " \t": # no obs-fold either
+                raise HttpError(400, "bad header line")
+            name = name.lower()
+            if name in headers: # repeated header is the same as a comma separated list
+                headers[name] += ", " + value.strip()
+            else:
+                headers[name] = value.strip()
+        self.headers = Headers(headers) # keys are lower-cased already
+
+    #HTTP/<digit>.<digit>, nothing float() would take besides
+    @staticmethod
+    def valid_version(version):
+        digits = "0123456789"
+        return len(version) == 8 and version.startswith("HTTP/") and version[5] in digits \
+            and version[6] == "." and version[7] in digits
+
+# 当客户端向服务器请求一个静态页面或者一张图片时，服务器可以很清楚的知道内容大小，然后通过Content - length消息首部字段告诉客户端
+# 需要接收多少数据。但是如果是动态页面等时，服务器是不可能预先知道内容大小，这时就可以使用Transfer - Encoding：chunk模式来传输
+# 数据了。即如果要一边产生数据，一边发给客户端，服务器就需要使用
+# "Transfer-Encoding: chunked"
+# 这样的方式来代替Content - Length
+# chunk编码将数据分成一块一块的发生。Chunked编码将使用若干个Chunk串连而成，由一个标明长度为0
+# 的chunk标示结束。每个Chunk分为头部和正文两部分，头部内容指定正文的字符总数（十六进制的数字 ）和数量单位（一般不写），正文部分就是指定长度的实际内容，两部分之间用回车换行(CRLF)
+# 隔开。在最后一个长度为0的Chunk中的内容是称为footer的内容，是一些附加的Header信息（通常可以直接忽略）。 Chunk编码的格式如下：
+#push decoder for identity and chunked bodies, both engines feed it whatever arrived.
+#feed() returns the decoded data as memoryviews over the input, once done the bytes
+#after the body (a pipelined request) are left in lefts
+class BodyDecoder:
+    max_line = 4096
+    hexdigits = frozenset(b"0123456789abcdefABCDEF")
+
+    def __init__(self, length=0, chunked=False):
+        self.chunked = chunked
+        self.length = length
+        self.remaining = length
+        self.line = bytearray()
+        self.lefts = None
+        if chunked:
+            self.state = "size"
+        else:
+            self.state = "data" if length > 0 else "done"
+        self.done = self.state == "done"
+
+    def feed(self, readbytes):
+        out = []
+        if self.done: # no body at all, everything belongs to the next request
+            self.lefts = readbytes if self.lefts is None else bytes(self.lefts) + bytes(readbytes)
+            return out
+        if not isinstance(readbytes, bytes):
+            readbytes = bytes(readbytes)
+        view = memoryview(readbytes)
+        pos, n = 0, len(readbytes)
+        while pos < n:
+            if self.state == "data":
+                take = min(self.remaining, n - pos)
+                out.append(view[pos:pos+take])
+                pos += take
+                self.remaining -= take
+                if self.remaining == 0:
+                    self.state = "crlf" if self.chunked else "done"
+            else: # chunk size line, CRLF after the data, or trailer lines
+                e = readbytes.find(b'\n', pos)
+                if e < 0:
+                    self.line += view[pos:]
+                    pos = n
+                else:
+                    self.line += view[pos:e]
+                    pos = e + 1
+                    self._line(bytes(self.line).rstrip(b'\r'))
+                    self.line = bytearray()
+                if len(self.line) > self.max_line:
+                    raise HttpError(400, "chunk line too long")
+            if self.state == "done":
+                self.done = True
+                self.lefts = view[pos:] if pos < n else None
+                break
+        return out
+
+    def _line(self, line):
+        if self.state == "size":
+            size = line.split(b';', 1)[0].rstrip(b" \t") # whitespace may only precede an extension
+            if not size or not self.hexdigits.issuperset(size): # int(, 16) would take "0x10", "+a" or "1_0"
+                raise HttpError(400, "bad chunk size")
+            size = int(size, 16)
+            if size == 0:
+                self.state = "trailer"
+            else:
+                self.remaining = size
+                self.state = "data"
+        elif self.state == "crlf":
+            if line:
+                raise HttpError(400, "missing CRLF after chunk")
+            self.state = "size"
+        elif not line: # an empty line ends the trailer, the trailer headers are ignored
+            self.state = "done"
+
+#request body storage, in memory up to threshold and in a temporary file beyond
+class BodySpool:
+    def __init__(self, threshold=None):
+        self.threshold = HttpHandler.spoolsize if threshold is None else threshold
+        self.buf = bytearray()
+        self.file = None
+        self.pos = 0
+        self.size = 0
+
+    def write(self, datas):
+        if self.file is None and len(self.buf) + len(datas) > self.threshold:
+            self.file = tempfile.TemporaryFile()
+            self.file.write(self.buf)
+            self.buf = None
+        if self.file is not None:
+            self.file.write(datas)
+        else:
+            self.buf += datas
+        self.size += len(datas)
+
+    def rewind(self):
+        if self.file is not None:
+            self.file.flush()
+            self.file.seek(0)
+        self.pos = 0
+
+    def read(self, size=-1):
+        if self.file is not None:
+            return self.file.read(size)
+        if size is None or size < 0:
+            size = len(self.buf) - self.pos
+        with memoryview(self.buf) as view:
+            datas = bytes(view[self.pos:self.pos+size])
+        self.pos += len(datas)
+        return datas
+
+    def getvalue(self):
+        return bytes(self.buf)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+#what handlers get as body. The threaded engine streams it off the socket while the handler
+#reads, the event loop has already spooled it when the handler runs.
+#read(size) returns b'' at the end like a file
+class RequestBody:
+    def __init__(self, decoder, expect=False):
+        self.decoder = decoder
+        self.expect = expect # 100 Continue owed to the client before it sends the body
+        self.readfunc = None
+        self.writefunc = None
+        self.chunks = collections.deque()
+        self.received = 0
+        self.spool = None
+        self.content_type = ""
+        self._form = None
+
+    @classmethod
+    def empty(cls):
+        return cls(BodyDecoder(0))
+
+    #the body as a Form, parsed from the unread rest on first access
+    def form(self):
+        if self._form is None:
+            self._form = Form(self.content_type, self)
+        return self._form
+
+    def __repr__(self):
+        return "<RequestBody {} bytes{}>".format(self.received, "" if self.decoder.done else "+")
+
+    def stream(self, readfunc, writefunc, lefts):
+        self.readfunc = readfunc
+        self.writefunc = writefunc
+        if lefts:
+            self.feed(lefts)
+
+    def collect(self, lefts):
+        self.spool = BodySpool()
+        if lefts:
+            self.feed(lefts)
+        return self.decoder.done
+
+    def feed(self, readbytes):
+        for chunk in self.decoder.feed(readbytes):
+            self.received += len(chunk)
+            if self.received > HttpHandler.bodylimits:
+                raise HttpError(413)
+            if self.spool is not None:
+                self.spool.write(chunk)
+            else: # a view into the bytes the reader returned, copied once when read
+                self.chunks.append(chunk)
+        if self.decoder.done and self.decoder.lefts is not None and self.readfunc is not None:
+            self.readfunc.unread(self.decoder.lefts)
+        return self.decoder.done
+
+    def _fill(self):
+        if self.expect:
+            self.expect = False
+            if self.writefunc:
+                self.writefunc(HttpHandler.continue_line)
+        readbytes = self.readfunc()
+        if not readbytes:
+            raise ConnectionError("connection closed while reading body")
+        self.feed(readbytes)
+
+    def finished(self):
+        return self.decoder.done
+
+    def read(self, size=-1):
+        if self.spool is not None:
+            return self.spool.read(size)
+        if size is None or size < 0:
+            while not self.decoder.done:
+                self._fill()
+            datas = b''.join(self.chunks)
+            self.chunks.clear()
+            return datas
+        while not self.chunks and not self.decoder.done:
+            self._fill()
+        if not self.chunks:
+            return b''
+        datas = self.chunks.popleft()
+        if len(datas) > size:
+            self.chunks.appendleft(datas[size:])
+            datas = datas[:size]
+        return bytes(datas)
+
+    def __iter__(self):
+        while True:
+            datas = self.read(65536)
+            if not datas:
+                break
+            yield datas
+
+    #the rest of the body, spooled and rewound. Small bodies stay in memory (spool.file is None)
+    def spooled(self):
+        if self.spool is None:
+            self.spool = BodySpool()
+            while self.chunks:
+                self.spool.write(self.chunks.popleft())
+            while not self.decoder.done:
+                self._fill()
+        self.spool.rewind()
+        return self.spool
+
+    #reads the unread rest off the wire so the next request on the connection lines up
+    def drain(self):
+        try:
+            while not self.decoder.done:
+                self._fill()
+                self.chunks.clear()
+        except (HttpError, ConnectionError, OSError):
+            return False
+        return True
+
+    def close(self):
+        self.chunks.clear()
+        if self.spool is not None:
+            self.spool.close()
+        if self._form is not None:
+            self._form.close()
+
+#main value and parameters of a header like Content-Type or Content-Disposition
+def header_params(value):
+    msg = email.message.Message()
+    msg["x"] = value
+    params = msg.get_params(header="x") or [("", "")]
+    return params[0][0].lower(), dict((k.lower(), email.utils.collapse_rfc2231_value(v)) for k, v in params[1:])
+
+#a form field, name and value stay raw bytes until they are asked for
+class FormField:
+    def __init__(self, name, value, quoted=False, charset="utf-8"):
+        self.raw_name = name
+        self.raw_value = value
+        self.quoted = quoted # urlencoded: %XX escapes and + for space
+        self.charset = charset
+        self._name = name if isinstance(name, str) else None
+        self._value = None
+
+    def __repr__(self):
+        return "<FormField {}>".format(self.name)
+
+    @property
+    def name(self):
+        if self._name is None:
+            self._name = self._decode(self.raw_name)
+        return self._name
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = self._decode(self.raw_value)
+        return self._value
+
+    def _decode(self, raw):
+        if self.quoted:
+            raw = unquote_to_bytes(raw.replace(b'+', b' '))
+        return raw.decode(self.charset, "replace")
+
+#an uploaded file, written to a temporary file while the body streams in
+class FormFile:
+    def __init__(self, name, filename, content_type, headers):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.headers = headers
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+
+    def __repr__(self):
+        return "<FormFile {} {} {} bytes>".format(self.name, self.filename, self.size)
+
+    def write(self, datas):
+        self.file.write(datas)
+        self.size += len(datas)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def save(self, path):
+        self.file.seek(0)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(self.file, f, 65536)
+        self.file.seek(0)
+
+    def close(self):
+        self.file.close()
+
+#incremental application/x-www-form-urlencoded decoder, keeps the raw pairs
+class UrlencodedDecoder:
+    def __init__(self, form):
+        self.form = form
+        self.tail = bytearray()
+
+    def feed(self, datas):
+        tail = self.tail
+        tail += datas
+        start = 0
+        while True:
+            e = tail.find(b'&', start)
+            if e < 0:
+                break
+            self._pair(bytes(tail[start:e]))
+            start = e + 1
+        del tail[:start]
+        if len(tail) > self.form.max_field_size:
+            raise HttpError(413, "form field too large")
+
+    def close(self):
+        self._pair(bytes(self.tail))
+        self.tail = bytearray()
+
+    def _pair(self, piece):
+        if piece:
+            name, _, value = piece.partition(b'=')
+            self.form.add(FormField(name, value, quoted=True))
+
+#streaming multipart/form-data parser. Fields are kept in memory up to max_field_size,
+#file parts go to disk as they arrive. Only the bytes that may still be the start of a
+#boundary are held back between feeds
+class MultipartDecoder:
+    max_header = 16384
+
+    def __init__(self, boundary, form):
+        self.form = form
+        self.delimiter = b"\r\n--" + boundary
+        self.buf = bytearray(b"\r\n") # the first boundary has no CRLF in front
+        self.state = "preamble"
+        self.part = None
+
+    def feed(self, datas):
+        buf = self.buf
+        buf += datas
+        delimiter = self.delimiter
+        while True:
+            if self.state == "preamble" or self.state == "data":
+                i = buf.find(delimiter)
+                if i < 0:
+                    keep = len(delimiter) - 1
+                    if len(buf) > keep:
+                        self._data(buf[:len(buf)-keep])
+                        del buf[:len(buf)-keep]
+                    return
+                self._data(buf[:i])
+                del buf[:i+len(delimiter)]
+                self._end()
+                self.state = "boundary"
+            elif self.state == "boundary":
+                if len(buf) < 2:
+                    return
+                if buf[:2] == b"--":
+                    self.state = "epilogue"
+                    del buf[:]
+                    return
+                e = buf.find(b"\r\n") # transport padding may follow the boundary
+                if e < 0:
+                    if len(buf) > self.max_header:
+                        raise HttpError(400, "bad multipart boundary")
+                    return
+                if buf[:e].strip(b" \t"):
+                    raise HttpError(400, "bad multipart boundary")
+                del buf[:e+2]
+                self.state = "headers"
+            elif self.state == "headers":
+                if buf[:2] == b"\r\n":
+                    e = 0
+                else:
+                    e = buf.find(b"\r\n\r\n")
+                    if e < 0:
+                        if len(buf) > self.max_header:
+                            raise HttpError(431, "multipart headers too large")
+                        return
+                    e += 2
+                self._start(bytes(buf[:e]).decode("utf-8", "replace"))
+                del buf[:e+2]
+                self.state = "data"
+            else: # epilogue
+                del buf[:]
+                return
+
+    def close(self):
+        if self.state != "epilogue":
+            raise HttpError(400, "multipart body ended early")
+
+    def _start(self, head):
+        headers = {}
+        for line in head.split("\r\n"):
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        disposition, params = header_params(headers.get("content-disposition", ""))
+        if disposition != "form-data" or "name" not in params:
+            self.part = None # not a form field, skipped
+        elif "filename" in params:
+            self.part = FormFile(params["name"], params["filename"],
+                                 headers.get("content-type", "application/octet-stream"), headers)
+            self.form.add(self.part)
+        else:
+            charset = header_params(headers.get("content-type", "text/plain"))[1].get("charset", "utf-8")
+            self.part = FormField(params["name"], bytearray(), charset=charset)
+            self.form.add(self.part)
+
+    def _data(self, datas):
+        part = self.part
+        if part is None or self.state != "data" or not datas:
+            return
+        if isinstance(part, FormFile):
+            part.write(datas)
+        else:
+            part.raw_value += datas
+            if len(part.raw_value) > self.form.max_field_size:
+                raise HttpError(413, "form field too large")
+
+    def _end(self):
+        if isinstance(self.part, FormField):
+            self.part.raw_value = bytes(self.part.raw_value)
+        elif isinstance(self.part, FormFile):
+            self.part.file.seek(0)
+        self.part = None
+
+#form fields of a request body, urlencoded or multipart. Nothing is read before the first
+#access, which parses the unread rest of the body, so a handler reading the body itself
+#leaves the form empty. get() returns the value of a field, or a FormFile for an upload
+class Form:
+    max_fields = 1000
+    max_field_size = 1024 * 1024 #larger fields get 413, files are only bound by --max-body
+    readsize = 65536
+
+    def __init__(self, content_type, stream):
+        self.content_type = content_type or ""
+        self.stream = stream # anything with read(size) returning bytes
+        self.fields = None
+
+    #the form of a cgi script, from its environment and stdin
+    @classmethod
+    def cgi(cls):
+        return cls(os.environ.get("CONTENT_TYPE", ""), sys.stdin.buffer)
+
+    def parse(self):
+        if self.fields is not None:
+            return self.fields
+        self.fields = []
+        ctype, params = header_params(self.content_type)
+        if ctype == "application/x-www-form-urlencoded":
+            decoder = UrlencodedDecoder(self)
+        elif ctype == "multipart/form-data":
+            boundary = params.get("boundary")
+            if not boundary or len(boundary) > 70:
+                raise HttpError(400, "bad multipart boundary")
+            decoder = MultipartDecoder(boundary.encode("latin-1"), self)
+        else: # not a form
+            return self.fields
+        while True:
+            datas = self.stream.read(self.readsize)
+            if not datas:
+                break
+            decoder.feed(datas)
+        decoder.close()
+        return self.fields
+
+    def add(self, field):
+        if len(self.fields) >= self.max_fields:
+            raise HttpError(413, "too many form fields")
+        self.fields.append(field)
+
+    def _value(self, field):
+        return field if isinstance(field, FormFile) else field.value
+
+    def get(self, name, default=None):
+        for field in self.parse():
+            if field.name == name:
+                return self._value(field)
+        return default
+
+    def getlist(self, name):
+        return [self._value(field) for field in self.parse() if field.name == name]
+
+    def files(self):
+        return [field for field in self.parse() if isinstance(field, FormFile)]
+
+    def __contains__(self, name):
+        return any(field.name == name for field in self.parse())
+
+    def __iter__(self):
+        seen = set()
+        for field in self.parse():
+            if field.name not in seen:
+                seen.add(field.name)
+                yield field.name
+
+    def close(self):
+        for field in self.fields or ():
+            if isinstance(field, FormFile):
+                field.close()
+
+class NeedMoreData(Exception):
+    pass
+
+#non-blocking counterpart of SocketReader: parse() runs over what has arrived so far,
+#raises NeedMoreData when it runs dry. The head parser keeps its state across retries,
+#the body is parsed again from the last commit() once more bytes come in
+class BufferReader:
+    limit = RequestParser.max_header_size + 65536
+
+    def __init__(self, readsize=HttpHandler.readsize):
+        self.readsize = readsize
+        self.buf = bytearray()
+        self.pos = 0
+
+    def __call__(self, size=None):
+        size = size or self.readsize
+        if self.pos >= len(self.buf):
+            raise NeedMoreData()
+        with memoryview(self.buf) as view:
+            readbytes = bytes(view[self.pos:self.pos+size])
+        self.pos += len(readbytes)
+        return readbytes
+
+    def unread(self, readbytes):
+        del self.buf[:self.pos]
+        self.pos = 0
+        self.buf[0:0] = readbytes
+
+    def feed(self, readbytes):
+        self.buf += readbytes
+
+    def take(self):
+        with memoryview(self.buf) as view:
+            readbytes = bytes(view[self.pos:])
+        del self.buf[:]
+        self.pos = 0
+        return readbytes
+
+    def pending(self):
+        return len(self.buf)
+
+    def rewind(self):
+        self.pos = 0
+
+    def commit(self):
+        del self.buf[:self.pos]
+        self.pos = 0
+
+#fixed size bytearrays reused across connections, so a connection reads with recv_into
+#into a buffer it got from here instead of allocating a fresh readsize bytes per recv.
+#deque append and pop are atomic, no lock needed
+class BufferPool:
+    def __init__(self, size, keep=256):
+        self.size = size
+        self.keep = keep
+        self.free = collections.deque()
+
+    def get(self, size=None):
+        if size is not None and size != self.size:
+            return bytearray(size)
+        try:
+            return self.free.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def put(self, buf):
+        if len(buf) == self.size and len(self.free) < self.keep:
+            self.free.append(buf)
+
+recv_buffers = BufferPool(HttpHandler.readsize)
+
+#response bodies that are produced while they are sent
+def is_stream(contents):
+    return contents is not None and not isinstance(contents, (bytes, bytearray, memoryview, StaticFile, StaticRange)) \
+        and hasattr(contents, "__iter__")
+
+#complete error responses for connections turned away before any request is read
+_canned_responses = {}
+def canned_response(status):
+    datas = _canned_responses.get(status)
+    if datas is None:
+        writer = BufferWriter()
+        response_headers = {"Connection": "close"}
+        if status in (429, 503):
+            response_headers["Retry-After"] = "1"
+        HttpHandler.response(writer, status, errorhtml(status, response_headers), response_headers)
+        datas = _canned_responses[status] = b''.join(writer.items)
+    return datas
+
+#best effort, a client that doesn't take it at once doesn't get it
+def refuse(client_sock, status):
+    try:
+        client_sock.setblocking(False)
+        client_sock.send(canned_response(status))
+    except OSError:
+        pass
+    finally:
+        client_sock.close()
+
+def read_filebytes(file):
+    with open(file, "rb") as f:
+        datas = f.read()
+    return datas
+def errorhtml(status, headers):
+    file = "htdocs/error.html"
+    with open(file, "rb") as f:
+        datas = f.read()
+        datas = datas.replace(b"[status]", str(status).encode())
+        datas = datas.replace(b"[errormsg]", HttpHandler.http_status_msg[status].encode())
+        headers["Content-Type"] = "text/html"
+        return datas
+
+#encoding: "gzip" for the compressed variant of a file, which has an etag of its own and
+#is never served in ranges. size overrides st.st_size for a variant compressed in memory
+class StaticFile:
+    def __init__(self, path, st, content_type, encoding=None, size=None):
+        self.path = path
+        self.size = st.st_size if size is None else size
+        self.mtime = st.st_mtime
+        self.content_type = content_type
+        self.encoding = encoding
+        self.datas = None
+        self.gzipped = None
+        self.checked = time.time()
+        self.etag = '"{:x}-{:x}{}"'.format(int(st.st_mtime * 1000000), self.size, "-gz" if encoding else "")
+        self.last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        self.validators = "ETag: {}\r\nLast-Modified: {}\r\n{}".format(self.etag, self.last_modified,
+            "Vary: Accept-Encoding\r\n" if compressible(content_type) else "").encode()
+        self.header = "Content-Type: {}\r\nContent-Length: {}\r\n{}".format(content_type, self.size,
+            "Content-Encoding: {}\r\n".format(encoding) if encoding else "Accept-Ranges: bytes\r\n"
+            ).encode() + self.validators + b"\r\n"
+
+    #bytes held in memory for this file and its compressed variant
+    def memsize(self):
+        size = len(self.datas) if self.datas is not None else 0
+        if self.gzipped is not None and self.gzipped.datas is not None:
+            size += len(self.gzipped.datas)
+        return size
+
+    #head: response bytes still to be sent in front of the file data
+    def write(self, writefunc, offset=0, count=None, head=b''):
+        if count is None:
+            count = self.size
+        if self.datas is not None:
+            if offset == 0 and count == self.size:
+                writefunc.writev((head, self.datas))
+            else:
+                writefunc.writev((head, memoryview(self.datas)[offset:offset+count]))
+        else: # large file never passes through python bytes
+            f = open(self.path, "rb")
+            if head:
+                writefunc(head, more=True)
+            writefunc.sendfile(f, offset, count)
+
+    # If-None-Match wins over If-Modified-Since, see rfc7232 section 6
+    def not_modified(self, headers):
+        inm = headers.get("If-None-Match")
+        if inm is not None:
+            if inm.strip() == "*":
+                return True
+            for tag in inm.split(","):
+                tag = tag.strip()
+                if tag.startswith("W/"):
+                    tag = tag[2:]
+                if tag == self.etag:
+                    return True
+            return False
+        ims = headers.get("If-Modified-Since")
+        if ims:
+            t = email.utils.parsedate_tz(ims)
+            if t:
+                return int(self.mtime) <= email.utils.mktime_tz(t)
+        return False
+
+#206 body of a static file, one range or multipart/byteranges for several
+class StaticRange:
+    def __init__(self, entry, ranges):
+        self.entry = entry
+        self.parts = []
+        ctype = entry.content_type
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            length = end - start + 1
+            self.parts.append((None, start, length))
+            self.trailer = None
+            self.header = "Content-Type: {}\r\nContent-Length: {}\r\nContent-Range: bytes {}-{}/{}\r\n".format(
+                ctype, length, start, end, entry.size).encode() + entry.validators + b"\r\n"
+            return
+        boundary = binascii.hexlify(os.urandom(12)).decode()
+        total = 0
+        for start, end in ranges:
+            prefix = "\r\n--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n".format(
+                boundary, ctype, start, end, entry.size).encode()
+            self.parts.append((prefix, start, end - start + 1))
+            total += len(prefix) + end - start + 1
+        self.trailer = "\r\n--{}--\r\n".format(boundary).encode()
+        total += len(self.trailer)
+        self.header = "Content-Type: multipart/byteranges; boundary={}\r\nContent-Length: {}\r\n".format(
+            boundary, total).encode() + entry.validators + b"\r\n"
+
+max_ranges = 16
+#Range: bytes=0-99,200-,-50 -> sorted, merged [(start, end)], end inclusive.
+#None means the header is ignored and the whole file is sent, [] means 416
+def parse_range(value, size):
+    unit, sep, spec = value.partition("=")
+    if not sep or unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, dash, last = part.partition("-")
+        first, last = first.strip(), last.strip()
+        if not dash or not (first.isdigit() or first == "" and last.isdigit()) \
+                or last and not last.isdigit():
+            return None
+        if first == "": # suffix, the last n bytes
+            n = int(last)
+            if n == 0:
+                continue
+            start, end = max(0, size - n), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                return None
+            if start >= size:
+                continue
+            end = min(end, size - 1)
+        ranges.append((start, end))
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    if len(merged) > max_ranges: # don't let a client split a download into thousands of parts
+        return None
+    return merged
+
+#If-Range holds a strong etag or the exact Last-Modified date
+def if_range_matches(entry, value):
+    value = value.strip()
+    if value.startswith('"'):
+        return value == entry.etag
+    return value == entry.last_modified
+
+#files under root, resolved safely. small ones are kept in a bounded LRU cache together with
+#their encoded headers, large ones are sent with sendfile. entries are revalidated against
+#mtime and size at most every check_interval seconds
+class StaticFiles:
+    index = "index.html"
+    check_interval = 1
+
+    def __init__(self, root, max_entries=256, max_file_size=256*1024, max_bytes=32*1024*1024):
+        self.root = os.path.realpath(root)
+        self.max_entries = max_entries
+        self.max_file_size = max_file_size
+        self.max_bytes = max_bytes
+        self.cache = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+
+    def resolve(self, path):
+        path = unquote(path)
+        if "\0" in path:
+            return None
+        fullpath = os.path.realpath(os.path.join(self.root, path.lstrip("/")))
+        if fullpath != self.root and not fullpath.startswith(self.root + os.sep):
+            return None
+        if os.path.isdir(fullpath):
+            fullpath = os.path.join(fullpath, self.index)
+        return fullpath
+
+    @staticmethod
+    def content_type(path):
+        ctype, encoding = mimetypes.guess_type(path)
+        if encoding == "gzip": # a .gz sibling fetched by its own name
+            return "application/gzip"
+        if not ctype:
+            return "application/octet-stream"
+        if ctype.startswith("text/"):
+            ctype += ";charset=utf-8"
+        return ctype
+
+    #scripts, compiled scripts and anything under __pycache__
+    def hidden(self, fullpath):
+        name = fullpath[len(self.root):].lower()
+        return name.endswith(cgi_extensions + compiled_extensions) or "__pycache__" in name.split(os.sep)
+
+    def get(self, path):
+        now = time.time()
+        with self.lock:
+            entry = self.cache.get(path)
+            if entry:
+                self.cache.move_to_end(path)
+        if entry and now - entry.checked < self.check_interval:
+            return 200, entry
+        fullpath = entry.path if entry else self.resolve(path)
+        if fullpath is None:
+            return 403, None
+        if self.hidden(fullpath): # never hand out script sources or their bytecode
+            return 404, None
+        try:
+            st = os.stat(fullpath)
+        except OSError:
+            self._evict(path)
+            return 404, None
+        if entry and entry.mtime == st.st_mtime and entry.size == st.st_size:
+            entry.checked = now
+            return 200, entry
+        entry = StaticFile(fullpath, st, self.content_type(fullpath))
+        if entry.size <= self.max_file_size:
+            try:
+                entry.datas = read_filebytes(fullpath)
+            except OSError:
+                self._evict(path)
+                return 404, None
+            if len(entry.datas) != entry.size: # changed while reading, next request retries
+                return 200, StaticFile(fullpath, st, entry.content_type)
+        entry.gzipped = self._gzipped(entry, st)
+        self._store(path, entry)
+        return 200, entry
+
+    #a .gz sibling at least as new as the file is served as is, otherwise a cached file is
+    #compressed here once. Large files without a sibling go out uncompressed
+    def _gzipped(self, entry, st):
+        if entry.size < gzip_min_size or not compressible(entry.content_type):
+            return None
+        gzpath = entry.path + ".gz"
+        try:
+            gzst = os.stat(gzpath)
+        except OSError:
+            gzst = None
+        if gzst is not None and gzst.st_mtime >= entry.mtime:
+            gz = StaticFile(gzpath, gzst, entry.content_type, "gzip")
+            if gz.size <= self.max_file_size:
+                try:
+                    gz.datas = read_filebytes(gzpath)
+                except OSError:
+                    return None
+                if len(gz.datas) != gz.size:
+                    return None
+            return gz
+        if entry.datas is None:
+            return None
+        datas = gzip_bytes(entry.datas)
+        if len(datas) >= entry.size:
+            return None
+        gz = StaticFile(entry.path, st, entry.content_type, "gzip", len(datas))
+        gz.datas = datas
+        return gz
+
+    def _store(self, path, entry):
+        size = entry.memsize()
+        with self.lock:
+            old = self.cache.pop(path, None)
+            if old:
+                self.cached_bytes -= old.memsize()
+            self.cache[path] = entry
+            self.cached_bytes += size
+            while len(self.cache) > self.max_entries or self.cached_bytes > self.max_bytes:
+                p, old = self.cache.popitem(last=False)
+                self.cached_bytes -= old.memsize()
+
+    def _evict(self, path):
+        with self.lock:
+            old = self.cache.pop(path, None)
+            if old:
+                self.cached_bytes -= old.memsize()
+
+compressible_types = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml")
+
+def compressible(content_type):
+    return gzip_level > 0 and content_type.startswith(compressible_types)
+
+#true when Accept-Encoding takes gzip, "gzip;q=0" refuses it and an explicit gzip wins over *
+def accepts_gzip(headers):
+    value = headers.get("Accept-Encoding")
+    if not value or gzip_level <= 0:
+        return False
+    star = False
+    for item in value.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if coding not in ("gzip", "x-gzip", "*"):
+            continue
+        q = 1.0
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if coding != "*":
+            return q > 0
+        star = q > 0
+    return star
+
+def gzip_bytes(datas):
+    c = zlib.compressobj(gzip_level, zlib.DEFLATED, 31) # 31: gzip header and trailer
+    return c.compress(datas) + c.flush()
+
+#every piece is flushed as it is compressed so a streamed response still streams
+def gzip_stream(stream):
+    c = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+    try:
+        for datas in stream:
+            if datas:
+                yield c.compress(datas) + c.flush(zlib.Z_SYNC_FLUSH)
+        yield c.flush()
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+
+#adds field to Vary, keeping what the handler or an upstream listed there already
+def add_vary(response_headers, field):
+    name = next((k for k in response_headers if k.lower() == "vary"), "Vary")
+    value = response_headers.get(name)
+    if not value:
+        response_headers[name] = field
+        return
+    values = value if isinstance(value, list) else [value]
+    listed = [v.strip().lower() for item in values for v in item.split(",")]
+    if field.lower() not in listed and "*" not in listed:
+        response_headers[name] = ", ".join(values + [field])
+
+#compresses a dynamic body when the client takes gzip, static files carry their own variant
+def gzip_response(datas, headers, response_headers):
+    if "Content-Encoding" in response_headers or not compressible(response_headers.get("Content-Type", "")):
+        return datas
+    if is_stream(datas):
+        add_vary(response_headers, "Accept-Encoding")
+        if not accepts_gzip(headers):
+            return datas
+        datas = gzip_stream(datas)
+    elif isinstance(datas, (bytes, bytearray)) and len(datas) >= gzip_min_size:
+        add_vary(response_headers, "Accept-Encoding")
+        if not accepts_gzip(headers):
+            return datas
+        datas = gzip_bytes(datas)
+    else:
+        return datas
+    response_headers["Content-Encoding"] = "gzip"
+    return datas
+
+static_files = StaticFiles("htdocs")
+cgi_extensions = (".py",)
+compiled_extensions = (".pyc", ".pyo")
+
+#what routes and in-process pages get. body is the RequestBody, read() it like a file,
+#params holds what the route pattern captured
+class Request:
+    def __init__(self, url, method, headers, body, addr=None):
+        up = urlparse(url)
+        self.url = url
+        self.method = method
+        self.raw_path = up.path or "/"
+        self.path = unquote(self.raw_path)
+        self.query = up.query
+        self.headers = headers
+        self.body = body
+        self.addr = addr
+        self.params = {}
+
+    @property
+    def has_body(self):
+        return "Content-Length" in self.headers or "Transfer-Encoding" in self.headers
+
+    @property
+    def form(self):
+        return self.body.form()
+
+#htdocs python files defining a module level handle(request) run inside the server, no
+#fork and no pipe. handle returns the body (str, bytes or an iterable of chunks), or
+#(status, body) or (status, headers, body). Files without handle are still plain cgi.
+#Modules are loaded once and reloaded when the file changes
+class PageModules:
+    check_interval = 1
+
+    def __init__(self, files):
+        self.files = files
+        self.pages = {}
+        self.lock = threading.Lock()
+
+    #the page's handle function, None when path is not a page
+    def get(self, path):
+        now = time.time()
+        page = self.pages.get(path)
+        if page and now - page[2] < self.check_interval:
+            return page[3]
+        with self.lock:
+            page = self.pages.get(path)
+            if page and now - page[2] < self.check_interval:
+                return page[3]
+            page = self._load(path, page, now)
+            if page is None:
+                self.pages.pop(path, None)
+                return None
+            self.pages[path] = page
+        return page[3]
+
+    def _load(self, path, page, now):
+        fullpath = page[0] if page else self.files.resolve(path)
+        if fullpath is None:
+            return None
+        try:
+            mtime = os.stat(fullpath).st_mtime
+        except OSError:
+            return None
+        if page and page[1] == mtime:
+            return fullpath, mtime, now, page[3]
+        try:
+            with open(fullpath, "rb") as f:
+                tree = ast.parse(f.read(), fullpath)
+        except (OSError, SyntaxError, ValueError):
+            traceback.print_exc()
+            return fullpath, mtime, now, None
+        #only a top-level def handle makes a page, anything else is a cgi script and importing it would run it
+        if not any(isinstance(node, ast.FunctionDef) and node.name == "handle" for node in tree.body):
+            return fullpath, mtime, now, None
+        code = compile(tree, fullpath, "exec")
+        module = types.ModuleType("page" + path.replace("/", "_")[:-3])
+        module.__file__ = fullpath
+        try:
+            exec(code, module.__dict__)
+        except Exception:
+            traceback.print_exc()
+            raise HttpError(500, "page failed to load: " + path)
+        handle = getattr(module, "handle", None)
+        return fullpath, mtime, now, handle if callable(handle) else None
+
+page_modules = PageModules(static_files)
+
+def run_page(handle, request, response_headers):
+    try:
+        result = handle(request)
+    except (HttpError, socket.timeout, ConnectionError): # the request itself failed, not the page
+        raise
+    except Exception:
+        traceback.print_exc()
+        return 500, b""
+    status, headers = 200, None
+    if isinstance(result, tuple):
+        if len(result) == 3:
+            status, headers, result = result
+        else:
+            status, result = result
+    response_headers["Content-Type"] = "text/html;charset=utf-8"
+    if headers:
+        for k, v in headers.items():
+            response_headers[k] = str(v)
+    if result is None:
+        result = b""
+    elif isinstance(result, str):
+        result = result.encode("utf-8")
+    return status, result
+
+#simply handle get, return url asset. post, cgi call
+class RouteNode:
+    def __init__(self):
+        self.children = {} # literal segment -> node
+        self.param = None # (name, node) of a <name> segment
+        self.handlers = {} # method -> func, pattern ends here
+        self.rest = None # (name, {method: func}) of a trailing *name, takes the rest of the path
+
+#routes compiled into a trie of path segments, a lookup follows the segments of the path
+#whatever the number of routes. Patterns: /stats literal, /users/<id> one segment into
+#params["id"], /files/*path the rest of the path (may be empty) into params["path"].
+#Literal segments win over <param>, which wins over *, a branch that dead-ends falls back to the next
+class Router:
+    def __init__(self):
+        self.root = RouteNode()
+
+    def add(self, methods, pattern, func):
+        if isinstance(methods, str):
+            methods = (methods,)
+        node = self.root
+        segments = pattern.strip("/").split("/") if pattern.strip("/") else []
+        for i, seg in enumerate(segments):
+            if seg.startswith("*"):
+                if i != len(segments) - 1:
+                    raise ValueError("* must be the last segment: " + pattern)
+                if node.rest is None:
+                    node.rest = (seg[1:] or "*", {})
+                elif node.rest[0] != (seg[1:] or "*"):
+                    raise ValueError("conflicting wildcard names: " + pattern)
+                self._set(node.rest[1], methods, func, pattern)
+                return
+            if seg.startswith("<") and seg.endswith(">"):
+                name = seg[1:-1]
+                if node.param is None:
+                    node.param = (name, RouteNode())
+                elif node.param[0] != name:
+                    raise ValueError("conflicting parameter names: " + pattern)
+                node = node.param[1]
+            else:
+                node = node.children.setdefault(seg, RouteNode())
+        self._set(node.handlers, methods, func, pattern)
+
+    @staticmethod
+    def _set(handlers, methods, func, pattern):
+        for method in methods:
+            if method in handlers:
+                raise ValueError("route registered twice: {} {}".format(method, pattern))
+            handlers[method] = func
+
+    #returns ({method: func}, params), handlers is None when no route matches the path
+    def match(self, path):
+        segments = path.strip("/").split("/") if path.strip("/") else []
+        params = {}
+        handlers = self._match(self.root, segments, 0, params)
+        if handlers is None:
+            return None, {}
+        return handlers, params
+
+    #depth first in the order literal, <param>, *; a dead end falls back to the next branch.
+    #params are only filled in on the way back from a match
+    def _match(self, node, segments, i, params):
+        if i == len(segments):
+            if node.handlers:
+                return node.handlers
+            if node.rest is not None:
+                params[node.rest[0]] = ""
+                return node.rest[1]
+            return None
+        seg = segments[i]
+        child = node.children.get(seg)
+        if child is not None:
+            handlers = self._match(child, segments, i + 1, params)
+            if handlers is not None:
+                return handlers
+        if node.param is not None:
+            handlers = self._match(node.param[1], segments, i + 1, params)
+            if handlers is not None:
+                params[node.param[0]] = unquote(seg)
+                return handlers
+        if node.rest is not None:
+            params[node.rest[0]] = unquote("/".join(segments[i:]))
+            return node.rest[1]
+        return None
+
+def stats_page(request, response_headers):
+    response_headers["Content-Type"] = "text/plain; version=0.0.4"
+    return 200, metrics.render().encode()
+
+#files under htdocs: python pages run in-process, other .py are cgi and never handed out
+def htdocs_get(request, response_headers):
+    headers = request.headers
+    path = request.raw_path
+    if request.path.endswith(cgi_extensions):
+        handle = page_modules.get(path)
+        if handle:
+            return run_page(handle, request, response_headers)
+        return 404, b""
+    status, entry = static_files.get(path)
+    if status != 200:
+        return status, entry
+    if entry.gzipped and "Range" not in headers and accepts_gzip(headers):
+        entry = entry.gzipped
+    if entry.not_modified(headers):
+        return 304, entry
+    rangehdr = headers.get("Range")
+    if rangehdr:
+        ifrange = headers.get("If-Range")
+        if ifrange is None or if_range_matches(entry, ifrange):
+            ranges = parse_range(rangehdr, entry.size)
+            if ranges == []:
+                response_headers["Content-Range"] = "bytes */{}".format(entry.size)
+                return 416, entry
+            if ranges:
+                return 206, StaticRange(entry, ranges)
+    return status, entry
+
+def htdocs_post(request, response_headers): # 是否执行cgi 其实与请求方法无关
+    path = request.raw_path
+    if request.path.endswith(cgi_extensions):
+        handle = page_modules.get(path)
+        if handle:
+            return run_page(handle, request, response_headers)
+    cgi = static_files.resolve(path)
+    if cgi is None:
+        return 403, b""
+    if not os.path.isfile(cgi):
+        return 400, b""
+    body = request.body
+    env = cgi_environ(request)
+    spool = body.spooled()
+    started = time.time()
+    if hooks.enabled:
+        hooks.before("cgi", hooks.info())
+    if cgi_workers > 0:
+        response_headers["Content-Type"] = "text/html;charset=utf-8"
+        return 200, cgi_pool().run(cgi, env, spool)
+    env.update((k, v) for k, v in os.environ.items() if k not in env)
+    #scripts can use `from httpd import Form`, the cgi workers have it on their path already
+    env["PYTHONPATH"] = os.pathsep.join(p for p in (os.path.dirname(httpd_script), env.get("PYTHONPATH")) if p)
+    try:
+        if spool.file is not None: # big body, the script reads the spooled file directly
+            p = subprocess.Popen(["python", cgi], stdin=spool.file, stdout=subprocess.PIPE, env=env)
+        else:
+            p = subprocess.Popen(["python", cgi], stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+    except OSError as e:
+        log.error("cgi start failed:", cgi, e)
+        cgi_done(started)
+        return 500, b""
+    if spool.file is None:
+        feed_stdin(p.stdin, spool.getvalue())
+    response_headers["Content-Type"] = "text/html;charset=utf-8"
+    return 200, cgi_output(p, started)
+
+#reverse proxy. Every upstream keeps a pool of HTTP/1.1 connections, request and response
+#bodies are streamed through. An upstream that fails max_fails times in a row is left out
+#for fail_timeout, then gets one request to prove itself again (passive health checks)
+
+#headers that describe a connection, not the message, never passed on
+hop_headers = frozenset(("connection", "keep-alive", "proxy-connection", "transfer-encoding", "te", "trailer",
+                         "upgrade", "proxy-authenticate", "proxy-authorization", "expect", "content-length"))
+
+#a failed proxied request. retry: the upstream never saw it, another one may take it
+class UpstreamError(Exception):
+    def __init__(self, status, msg, retry=False):
+        Exception.__init__(self, msg)
+        self.status = status
+        self.retry = retry
+
+class UpstreamConn:
+    max_head = 65536
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.sock = socket.create_connection(upstream.addr, proxy_connect_timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(proxy_timeout)
+        self.buf = b''
+        self.served = 0
+
+    #an idle connection that became readable was closed by the upstream (or got junk)
+    def stale(self):
+        try:
+            return bool(select.select([self.sock], [], [], 0)[0])
+        except (OSError, ValueError):
+            return True
+
+    def recv(self):
+        datas = self.sock.recv(65536)
+        if not datas:
+            raise ConnectionError("upstream closed the connection")
+        return datas
+
+    #(status, [(name, value)]), interim 1xx responses are skipped
+    def readHead(self):
+        while True:
+            e = self.buf.find(b"\r\n\r\n")
+            if e < 0:
+                if len(self.buf) > self.max_head:
+                    raise UpstreamError(502, "upstream head too large")
+                self.buf += self.recv()
+                continue
+            head, self.buf = self.buf[:e], self.buf[e+4:]
+            lines = head.decode("latin-1").split("\r\n")
+            parts = lines[0].split(None, 2)
+            if len(parts) < 2 or not parts[0].startswith("HTTP/1.") or not parts[1].isdigit():
+                raise UpstreamError(502, "bad upstream status line")
+            status = int(parts[1])
+            if 100 <= status < 200:
+                continue
+            headers = []
+            for line in lines[1:]:
+                name, sep, value = line.partition(":")
+                if sep:
+                    headers.append((name.strip(), value.strip()))
+            return status, headers
+
+    def close(self):
+        self.sock.close()
+
+#the body of an upstream response as the client gets it. The connection goes back to the
+#pool once the body is read to its end, a client that goes away first costs the connection
+class UpstreamResponse:
+    def __init__(self, conn, decoder, keepalive):
+        self.conn = conn
+        self.decoder = decoder # None: the body ends when the upstream closes
+        self.keepalive = keepalive
+        self.done = False
+
+    def __iter__(self):
+        conn, decoder = self.conn, self.decoder
+        try:
+            if decoder is None:
+                while True:
+                    datas = conn.sock.recv(65536)
+                    if not datas:
+                        break
+                    yield datas
+            else:
+                datas, conn.buf = conn.buf, b''
+                while True:
+                    if datas:
+                        for chunk in decoder.feed(datas):
+                            yield chunk
+                    if decoder.done:
+                        break
+                    datas = conn.recv()
+            self.done = True
+        except OSError as e: # headers are out, all that's left is cutting the response short
+            log.warn("upstream body failed:", conn.upstream.name, e)
+            conn.upstream.failed()
+            raise
+        finally:
+            self.close()
+
+    def close(self):
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        reusable = self.done and self.keepalive and (self.decoder is None or self.decoder.lefts is None)
+        conn.upstream.release(conn, reusable)
+
+class Upstream:
+    max_fails = 3
+    fail_timeout = 10
+
+    def __init__(self, host, port):
+        self.addr = (host, port)
+        self.name = "{}:{}".format(host, port)
+        self.idle = collections.deque()
+        self.lock = threading.Lock()
+        self.active = 0 # requests in flight, for least-conn
+        self.fails = 0
+        self.down_until = 0
+
+    def available(self, now):
+        return now >= self.down_until
+
+    def failed(self):
+        with self.lock:
+            self.fails += 1
+            if self.fails >= self.max_fails:
+                if self.down_until <= time.time():
+                    log.warn("upstream down:", self.name)
+                self.down_until = time.time() + self.fail_timeout
+
+    def succeeded(self):
+        if self.fails:
+            with self.lock:
+                self.fails = 0
+                self.down_until = 0
+
+    #an idle pooled connection, or a new one. reused tells whether it was pooled
+    def acquire(self):
+        while True:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                break
+            if not conn.stale():
+                return conn, True
+            conn.close()
+        try:
+            return UpstreamConn(self), False
+        except socket.timeout:
+            raise UpstreamError(504, "connect to {} timed out".format(self.name), retry=True)
+        except OSError as e:
+            raise UpstreamError(502, "connect to {} failed: {}".format(self.name, e), retry=True)
+
+    def release(self, conn, reusable):
+        with self.lock:
+            self.active -= 1
+            if reusable and len(self.idle) < proxy_keepalive:
+                conn.served += 1
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    #sends the request, returns (status, contents) with the response headers filled in
+    def forward(self, request, head, response_headers):
+        with self.lock:
+            self.active += 1
+        body = request.body
+        for attempt in (0, 1):
+            try:
+                conn, reused = self.acquire()
+            except UpstreamError:
+                with self.lock:
+                    self.active -= 1
+                raise
+            sent = False # once body bytes are gone there is no retry
+            reading = False # errors while reading the client's body are the client's
+            try:
+                conn.sock.sendall(head)
+                if request.has_body:
+                    sent = True
+                    chunked = "Transfer-Encoding" in request.headers # same framing as proxy_head
+                    while True:
+                        reading = True
+                        datas = body.read(65536)
+                        reading = False
+                        if not datas:
+                            break
+                        conn.sock.sendall(b"%x\r\n%s\r\n" % (len(datas), datas) if chunked else datas)
+                    if chunked:
+                        conn.sock.sendall(b"0\r\n\r\n")
+                status, headers = conn.readHead()
+                break
+            except UpstreamError:
+                self.release(conn, False)
+                raise
+            except (HttpError, OSError) as e:
+                self.release(conn, False)
+                if reading or isinstance(e, HttpError):
+                    raise
+                if isinstance(e, socket.timeout):
+                    raise UpstreamError(504, "{} timed out".format(self.name))
+                if reused and not sent and attempt == 0: # the upstream closed an idle connection just now
+                    with self.lock:
+                        self.active += 1
+                    continue
+                raise UpstreamError(502, "{} failed: {}".format(self.name, e), retry=not sent)
+        self.succeeded()
+        keepalive = True
+        length = None
+        chunked = False
+        for name, value in headers:
+            lname = name.lower()
+            if lname == "connection":
+                keepalive = "close" not in value.lower()
+            elif lname == "transfer-encoding":
+                chunked = value.lower().endswith("chunked")
+            elif lname == "content-length":
+                if not value or not HttpHandler.digits.issuperset(value) or length not in (None, int(value)):
+                    self.release(conn, False)
+                    raise UpstreamError(502, "bad upstream content-length")
+                length = int(value)
+            if lname in hop_headers:
+                continue
+            name = "-".join(w.capitalize() for w in lname.split("-")) # so it meets ours, like Vary
+            old = response_headers.get(name)
+            if old is None:
+                response_headers[name] = value
+            elif isinstance(old, list):
+                old.append(value)
+            else:
+                response_headers[name] = [old, value]
+        if status == 204 or status == 304:
+            self.release(conn, keepalive)
+            return status, b""
+        if chunked:
+            decoder = BodyDecoder(chunked=True)
+        elif length is not None:
+            decoder = BodyDecoder(length)
+        else:
+            decoder, keepalive = None, False
+        return status, UpstreamResponse(conn, decoder, keepalive)
+
+class UpstreamGroup:
+    balances = ("round-robin", "least-conn")
+
+    def __init__(self, upstreams, balance="round-robin"):
+        if balance not in self.balances:
+            raise ValueError("unknown balance: " + balance)
+        self.upstreams = upstreams
+        self.balance = balance
+        self.next = 0
+
+    @classmethod
+    def parse(cls, spec, balance="round-robin"):
+        upstreams = []
+        for addr in spec.split(","):
+            host, _, port = addr.strip().rpartition(":")
+            upstreams.append(Upstream(host or "127.0.0.1", int(port)))
+        return cls(upstreams, balance)
+
+    def pick(self, tried):
+        now = time.time()
+        candidates = [u for u in self.upstreams if u not in tried and u.available(now)]
+        if not candidates: # all down, try the ones not tried yet anyway
+            candidates = [u for u in self.upstreams if u not in tried]
+            if not candidates:
+                return None
+        self.next += 1 # a lost update under threads only skews the rotation
+        if self.balance == "least-conn":
+            least = min(u.active for u in candidates)
+            candidates = [u for u in candidates if u.active == least]
+        return candidates[self.next % len(candidates)]
+
+    #route func
+    def handle(self, request, response_headers):
+        head = proxy_head(request)
+        tried = []
+        while True:
+            upstream = self.pick(tried)
+            if upstream is None:
+                return 502, b""
+            tried.append(upstream)
+            try:
+                return upstream.forward(request, head, response_headers)
+            except UpstreamError as e:
+                log.warn("proxy:", e)
+                upstream.failed()
+                if not e.retry:
+                    return e.status, b""
+
+#request line and headers as the upstream gets them
+def proxy_head(request):
+    headers = request.headers
+    lines = ["{} {} HTTP/1.1\r\n".format(request.method, request.url)]
+    hop = set(hop_headers)
+    for name in headers.get("Connection", "").lower().split(","): # named in Connection are hop-by-hop too
+        hop.add(name.strip())
+    for name, value in headers.items():
+        if name not in hop and name != "x-forwarded-for":
+            lines.append("{}: {}\r\n".format(name, value))
+    forwarded = headers.get("X-Forwarded-For")
+    client = request.addr[0] if request.addr else None
+    if client:
+        lines.append("X-Forwarded-For: {}\r\n".format(forwarded + ", " + client if forwarded else client))
+    elif forwarded:
+        lines.append("X-Forwarded-For: {}\r\n".format(forwarded))
+    if request.has_body: # the framing of the client's body as we parsed it, never its raw header
+        if "Transfer-Encoding" in headers:
+            lines.append("Transfer-Encoding: chunked\r\n")
+        else:
+            lines.append("Content-Length: {}\r\n".format(request.body.decoder.length))
+    lines.append("\r\n")
+    return "".join(lines).encode("latin-1")
+
+def add_proxy(pattern, spec):
+    proxy_routes.append((pattern, UpstreamGroup.parse(spec, proxy_balance)))
+    upstreams = lambda: [u for _, group in proxy_routes for u in group.upstreams]
+    metrics.gauge("httpd_upstream_active", "Proxied requests in flight.",
+                  lambda: dict((u.name, u.active) for u in upstreams()), "upstream")
+    metrics.gauge("httpd_upstream_up", "Upstreams taking requests, 0 while failing.",
+                  lambda: dict((u.name, int(u.available(time.time()))) for u in upstreams()), "upstream")
+
+#opt-in cache for dynamic responses on the routes added with add(pattern). Entries are keyed
+#on method, path, query and a hash of the body, expire after ttl and are evicted least
+#recently used first beyond max_entries or max_bytes. The handler's Cache-Control wins:
+#no-store, no-cache and private are never kept, s-maxage or max-age replace ttl. Concurrent
+#misses of one key run the handler once, the others wait for its entry (no stampede)
+class CachedResponse:
+    def __init__(self, status, headers, datas, ttl):
+        self.status = status
+        self.headers = headers
+        self.datas = datas
+        self.gzipped = None # compressed once when stored, served to clients taking gzip
+        self.stored = time.time()
+        self.expires = self.stored + ttl
+        if status == 200 and "Content-Encoding" not in headers and len(datas) >= gzip_min_size \
+                and compressible(headers.get("Content-Type", "")):
+            self.gzipped = gzip_bytes(datas)
+        self.size = len(datas) + (len(self.gzipped) if self.gzipped else 0) + 256 # + headers, roughly
+
+class ResponseCache:
+    methods = ("GET", "POST")
+    statuses = (200, 203, 300, 301, 404, 410)
+    max_entry_size = 1024 * 1024
+    fill_timeout = 30 # longest wait for another request filling the same key
+
+    def __init__(self, ttl=60, max_entries=1024, max_bytes=64*1024*1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.routes = Router()
+        self.enabled = False
+        self.entries = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.filling = {} # key -> Event set when the request filling it is done
+        self.lock = threading.Lock()
+
+    def add(self, pattern):
+        self.routes.add(self.methods, pattern, True)
+        if not self.enabled:
+            self.enabled = True
+            metrics.gauge("httpd_cache_entries", "Responses in the response cache.", lambda: len(self.entries))
+            metrics.gauge("httpd_cache_bytes", "Bytes held by the response cache.", lambda: self.cached_bytes)
+
+    def matches(self, request):
+        if "Authorization" in request.headers: # per user, never shared
+            return False
+        handlers = self.routes.match(request.raw_path)[0]
+        return handlers is not None and request.method in handlers
+
+    @staticmethod
+    def key(request):
+        digest = ""
+        if request.has_body:
+            spool = request.body.spooled()
+            h = hashlib.sha256()
+            if spool.file is None:
+                h.update(spool.getvalue())
+            else:
+                while True:
+                    datas = spool.read(65536)
+                    if not datas:
+                        break
+                    h.update(datas)
+                spool.rewind()
+            digest = h.hexdigest()
+        return request.method, request.raw_path, request.query, request.headers.get("Content-Type", ""), digest
+
+    def handle(self, func, request, response_headers):
+        key = self.key(request)
+        entry, fill = self._lookup(key)
+        if entry is not None:
+            metrics.inc(("cache", "hit"))
+            response_headers["Age"] = str(int(time.time() - entry.stored))
+            return self._serve(entry, request, response_headers, "HIT")
+        if fill is None: # the request we waited for didn't store anything
+            metrics.inc(("cache", "pass"))
+            return func(request, response_headers)
+        try:
+            status, contents = func(request, response_headers)
+            datas, contents = self._collect(contents)
+            entry = self._entry(status, response_headers, datas)
+            if entry is None:
+                metrics.inc(("cache", "pass"))
+                return status, contents
+            self._store(key, entry)
+        except Exception: # handler or its stream failed, the client gets the error, nothing is stored
+            metrics.inc(("cache", "error"))
+            raise
+        finally:
+            with self.lock:
+                self.filling.pop(key, None)
+            fill.set()
+        metrics.inc(("cache", "miss"))
+        return self._serve(entry, request, response_headers, "MISS")
+
+    #(entry, None) on a hit, (None, event) when this request is to fill the key, (None, None)
+    #when another one was filling it and stored nothing
+    def _lookup(self, key):
+        waited = False
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    if entry.expires > time.time():
+                        self.entries.move_to_end(key)
+                        return entry, None
+                    del self.entries[key]
+                    self.cached_bytes -= entry.size
+                if waited:
+                    return None, None
+                event = self.filling.get(key)
+                if event is None:
+                    event = self.filling[key] = threading.Event()
+                    return None, event
+            event.wait(self.fill_timeout)
+            waited = True
+
+    @staticmethod
+    def _serve(entry, request, response_headers, result):
+        response_headers.update(entry.headers)
+        response_headers["X-Cache"] = result
+        if entry.gzipped is not None:
+            add_vary(response_headers, "Accept-Encoding")
+            if accepts_gzip(request.headers):
+                response_headers["Content-Encoding"] = "gzip"
+                return entry.status, entry.gzipped
+        return entry.status, entry.datas
+
+    #(bytes to keep or None, contents to send). Streams are read up to max_entry_size, a
+    #longer one goes out as it was with what has been read put back in front. Only a stream
+    #that ends cleanly is kept: one that raises (a cgi that died or exited nonzero) is closed
+    #and the error passes on
+    def _collect(self, contents):
+        if isinstance(contents, (bytes, bytearray)):
+            return bytes(contents), contents
+        if not is_stream(contents):
+            return None, contents
+        parts, size = [], 0
+        it = iter(contents)
+        try:
+            for datas in it:
+                parts.append(datas)
+                size += len(datas)
+                if size > self.max_entry_size:
+                    return None, self._rest(parts, it, contents)
+        except BaseException:
+            self._close(contents)
+            raise
+        self._close(contents)
+        datas = b"".join(parts)
+        return datas, datas
+
+    def _rest(self, parts, it, contents):
+        try:
+            for datas in parts:
+                yield datas
+            for datas in it:
+                yield datas
+        finally:
+            self._close(contents)
+
+    @staticmethod
+    def _close(contents):
+        close = getattr(contents, "close", None)
+        if close:
+            close()
+
+    def _entry(self, status, response_headers, datas):
+        if datas is None or status not in self.statuses or len(datas) > self.max_entry_size:
+            return None
+        names = dict((k.lower(), v) for k, v in response_headers.items())
+        if "set-cookie" in names or "vary" in names:
+            return None
+        ttl = self.ttl
+        control = names.get("cache-control")
+        if control:
+            if isinstance(control, list):
+                control = ",".join(control)
+            shared = None
+            for item in control.lower().split(","):
+                name, _, value = item.strip().partition("=")
+                if name in ("no-store", "no-cache", "private"):
+                    return None
+                try:
+                    if name == "max-age":
+                        ttl = int(value.strip('"'))
+                    elif name == "s-maxage":
+                        shared = int(value.strip('"'))
+                except ValueError:
+                    return None
+            if shared is not None:
+                ttl = shared
+        if ttl <= 0:
+            return None
+        return CachedResponse(status, dict(response_headers), datas, ttl)
+
+    def _store(self, key, entry):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.cached_bytes -= old.size
+            self.entries[key] = entry
+            self.cached_bytes += entry.size
+            while len(self.entries) > self.max_entries or self.cached_bytes > self.max_bytes:
+                k, old = self.entries.popitem(last=False)
+                self.cached_bytes -= old.size
+
+response_cache = ResponseCache()
+
+#route funcs take (request, response_headers) and return (status, contents)
+def default_router():
+    router = Router()
+    if stats_path:
+        router.add("GET", stats_path, stats_page)
+    for pattern, group in proxy_routes:
+        router.add(HttpHandler.implement_methods, pattern, group.handle)
+    router.add("GET", "/*path", htdocs_get)
+    router.add("POST", "/*path", htdocs_post)
+    return router
+
+router = default_router()
+
+def handler(url, method, headers, body, response_headers, addr=None):
+    request = Request(url, method, headers, body, addr)
+    handlers, request.params = router.match(request.raw_path)
+    if handlers is None:
+        return 404, b""
+    func = handlers.get(method)
+    if func is None:
+        response_headers["Allow"] = ", ".join(sorted(handlers))
+        return 405, b""
+    if response_cache.enabled and response_cache.matches(request):
+        return response_cache.handle(func, request, response_headers)
+    return func(request, response_headers)
+
+def cgi_environ(request):
+    spool = request.body.spooled()
+    return {
+        "GATEWAY_INTERFACE": "CGI/1.1",
+        "REQUEST_METHOD": request.method,
+        "SCRIPT_NAME": request.path,
+        "QUERY_STRING": request.query,
+        "CONTENT_LENGTH": str(spool.size),
+        "CONTENT_TYPE": request.headers.get("Content-Type", ""),
+    }
+
+pipe_buffer = 65536
+#a body that fits the pipe buffer is written at once, a bigger one from a helper thread
+#so the script can't deadlock writing stdout while we are still writing its stdin
+def feed_stdin(stdin, datas):
+    def feed():
+        try:
+            if datas:
+                stdin.write(datas)
+        except OSError: # script exited without reading everything
+            pass
+        finally:
+            try:
+                stdin.close()
+            except OSError:
+                pass
+    if len(datas) <= pipe_buffer:
+        feed()
+    else:
+        t = threading.Thread(target=feed)
+        t.daemon = True
+        t.start()
+
+#yields cgi stdout as it is produced, reading the pipe only as fast as the client takes it
+def cgi_output(p, started):
+    try:
+        while True:
+            datas = p.stdout.read1(65536)
+            if not datas:
+                break
+            yield datas
+        if p.wait():
+            raise HttpError(502, "cgi exited with status {}".format(p.returncode))
+    finally:
+        if p.poll() is None: # client went away, don't leave the script behind
+            p.kill()
+            p.wait()
+        p.stdout.close()
+        cgi_done(started)
+
+#ends the cgi phase begun in htdocs_post, also when the script never got to run
+def cgi_done(started):
+    seconds = time.time() - started
+    metrics.observe("cgi", seconds)
+    if hooks.enabled:
+        hooks.after("cgi", hooks.info(), seconds)
+
+#length prefixed frames between the server and a cgi worker over a pair of pipes.
+#server -> worker: R request (json), I stdin data, E end of stdin
+#worker -> server: O stdout data, X script finished (exit code)
+class CgiChannel:
+    frame = struct.Struct("!cI")
+
+    def __init__(self, rfd, wfd):
+        self.rfd = rfd
+        self.wfd = wfd
+        self.buf = bytearray()
+
+    def send(self, kind, payload=b''):
+        datas = memoryview(self.frame.pack(kind, len(payload)) + payload)
+        while datas:
+            n = os.write(self.wfd, datas)
+            datas = datas[n:]
+
+    def recv(self, deadline=None):
+        buf = self.buf
+        size = self.frame.size
+        while True:
+            if len(buf) >= size:
+                kind, n = self.frame.unpack_from(buf)
+                if len(buf) >= size + n:
+                    payload = bytes(buf[size:size+n])
+                    del buf[:size+n]
+                    return kind, payload
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not select.select([self.rfd], [], [], remaining)[0]:
+                    raise TimeoutError("cgi worker timed out")
+            datas = os.read(self.rfd, 65536)
+            if not datas:
+                return None, b''
+            buf += datas
+
+#long-lived `python httpd.py --cgi-worker` process, runs one request at a time
+class CgiWorker:
+    def __init__(self):
+        self.proc = subprocess.Popen([sys.executable, httpd_script, "--cgi-worker"],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+        self.channel = CgiChannel(self.proc.stdout.fileno(), self.proc.stdin.fileno())
+        self.served = 0
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def close(self, kill=False):
+        if kill and self.alive():
+            self.proc.kill()
+        try:
+            self.proc.stdin.close() # eof, an idle worker exits by itself
+        except OSError:
+            pass
+        self.proc.wait()
+        self.proc.stdout.close()
+
+#fastcgi style pool: scripts are compiled once per worker and run in-process there, each
+#request with its own environment, stdin and stdout. A worker is recycled after
+#max_requests and killed when a request runs longer than timeout
+class CgiPool:
+    def __init__(self, size, max_requests=1000, timeout=30):
+        self.size = size
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.idle = []
+        self.count = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        deadline = time.time() + self.timeout
+        with self.cond:
+            while not self.idle and self.count >= self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise HttpError(503, "no cgi worker available")
+                self.cond.wait(remaining)
+            if self.idle:
+                return self.idle.pop()
+            self.count += 1
+        try:
+            return CgiWorker()
+        except OSError:
+            with self.cond:
+                self.count -= 1
+                self.cond.notify()
+            raise HttpError(500, "cgi worker failed to start")
+
+    def release(self, worker, reusable):
+        worker.served += 1
+        if reusable and worker.served < self.max_requests and worker.alive():
+            with self.cond:
+                self.idle.append(worker)
+                self.cond.notify()
+            return
+        worker.close(kill=not reusable)
+        with self.cond:
+            self.count -= 1
+            self.cond.notify()
+
+    #sends the request, waits for the first output so a dead or hung worker still gets an
+    #error status, then streams the rest
+    def run(self, script, env, spool):
+        started = time.time()
+        try:
+            worker = self.acquire()
+            kind, payload = self._start(worker, script, env, spool, started + self.timeout)
+        except HttpError:
+            cgi_done(started)
+            raise
+        return self._output(worker, started + self.timeout, kind, payload, started)
+
+    def _start(self, worker, script, env, spool, deadline):
+        try:
+            worker.channel.send(b'R', json.dumps({"script": script, "env": env}).encode())
+            while True:
+                datas = spool.read(65536)
+                if not datas:
+                    break
+                worker.channel.send(b'I', datas)
+            worker.channel.send(b'E')
+            kind, payload = worker.channel.recv(deadline)
+        except TimeoutError:
+            self.release(worker, False)
+            raise HttpError(504, "cgi timed out: " + script)
+        except OSError:
+            self.release(worker, False)
+            raise HttpError(502, "cgi worker died")
+        if kind is None:
+            self.release(worker, False)
+            raise HttpError(502, "cgi worker died")
+        return kind, payload
+
+    def _output(self, worker, deadline, kind, payload, started):
+        finished = False
+        try:
+            while kind == b'O':
+                yield payload
+                kind, payload = worker.channel.recv(deadline)
+            finished = kind == b'X'
+        except TimeoutError:
+            raise HttpError(504, "cgi timed out")
+        finally:
+            self.release(worker, finished)
+            cgi_done(started)
+        #the output so far is incomplete, the caller must not end the response cleanly
+        if not finished:
+            raise HttpError(502, "cgi worker died")
+        if payload != b'0':
+            raise HttpError(502, "cgi exited with status " + payload.decode())
+
+_cgi_pool = None
+_cgi_pool_lock = threading.Lock()
+def cgi_pool():
+    global _cgi_pool
+    if _cgi_pool is None: # created lazily, so every pre-forked process gets its own
+        with _cgi_pool_lock:
+            if _cgi_pool is None:
+                _cgi_pool = CgiPool(cgi_workers, cgi_max_requests, cgi_timeout)
+                pool = _cgi_pool
+                metrics.gauge("httpd_cgi_workers", "Cgi worker processes.",
+                              lambda: {"idle": len(pool.idle), "busy": pool.count - len(pool.idle)}, "state")
+    return _cgi_pool
+
+class CgiOutput(io.RawIOBase):
+    def __init__(self, channel):
+        self.channel = channel
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.channel.send(b'O', bytes(b))
+        return len(b)
+
+#the worker side. The protocol pipes are moved off fd 0/1 so stray writes of a script
+#or its children can't corrupt the frames
+def cgi_worker_main():
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # ctrl-c goes to the whole group, the server stops us
+    channel = CgiChannel(os.dup(0), os.dup(1))
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.dup2(2, 1)
+    base_env = dict(os.environ)
+    codes = {}
+    while True:
+        kind, payload = channel.recv()
+        if kind is None:
+            break
+        if kind != b'R':
+            continue
+        request = json.loads(payload.decode())
+        stdin = io.BytesIO()
+        while True:
+            kind, payload = channel.recv()
+            if kind != b'I':
+                break
+            if isinstance(stdin, io.BytesIO) and stdin.tell() + len(payload) > HttpHandler.spoolsize:
+                spooled = tempfile.TemporaryFile()
+                spooled.write(stdin.getvalue())
+                stdin = spooled
+            stdin.write(payload)
+        if kind is None:
+            break
+        stdin.seek(0)
+        status = cgi_exec(codes, request["script"], base_env, request["env"], stdin, channel)
+        stdin.close()
+        channel.send(b'X', str(status).encode())
+
+def cgi_exec(codes, script, base_env, env, stdin, channel):
+    try:
+        mtime = os.stat(script).st_mtime
+        cached = codes.get(script)
+        if cached is None or cached[0] != mtime:
+            with open(script, "rb") as f:
+                cached = mtime, compile(f.read(), script, "exec")
+            codes[script] = cached
+    except (OSError, SyntaxError):
+        traceback.print_exc()
+        return 1
+    os.environ.clear()
+    os.environ.update(base_env)
+    os.environ.update(env)
+    out = io.TextIOWrapper(io.BufferedWriter(CgiOutput(channel), 65536), encoding="utf-8")
+    saved = sys.stdin, sys.stdout, sys.argv
+    sys.stdin = io.TextIOWrapper(stdin, encoding="utf-8")
+    sys.stdout = out
+    sys.argv = [script]
+    status = 0
+    try:
+        exec(cached[1], {"__name__": "__main__", "__file__": script, "__builtins__": __builtins__})
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        try:
+            out.flush()
+        except OSError:
+            pass
+        out.detach()
+        sys.stdin.detach()
+        sys.stdin, sys.stdout, sys.argv = saved
+    return status
+
+def serve_request(parsed, write_func, served, addr=None):
+    if profiler.active:
+        return profiler.run(process_request, parsed, write_func, served, addr)
+    return process_request(parsed, write_func, served, addr)
+
+def process_request(parsed, write_func, served, addr=None):
+    started, sent = time.time(), write_func.sent
+    status, url, method, ver, headers, body = parsed
+    keepalive = status == HttpHandler.INTERNAL_OK and HttpHandler.keepalive(ver, headers) \
+        and served < keepalive_requests and not draining
+    response_headers = {}
+    datas = None
+    info = None
+    if hooks.enabled:
+        info = hooks.local.info = {"method": method, "url": url, "addr": addr, "status": status}
+    try:
+        if status == HttpHandler.INTERNAL_OK: #continue proceed
+            if info is not None:
+                hooks.before("handler", info)
+            try:
+                status, datas = handler(url, method, headers, body, response_headers, addr)
+            except HttpError as e: # body turned out bad or too large while the handler read it
+                status, keepalive = e.status, False
+            except socket.timeout: # body stalled while the handler read it
+                status, keepalive = 408, False
+            seconds = time.time() - started
+            metrics.observe("handler", seconds)
+            if info is not None:
+                info["status"] = status
+                hooks.after("handler", info, seconds)
+        if status >= 400 and not isinstance(datas, UpstreamResponse): # upstreams send their own
+            if info is not None:
+                info["status"] = status
+                hooks.before("error", info)
+                t = time.time()
+            datas = errorhtml(status, response_headers)
+            if info is not None:
+                hooks.after("error", info, time.time() - t)
+        elif status == 200:
+            datas = gzip_response(datas, headers, response_headers)
+        if ver < 1.1 and is_stream(datas): # no chunked encoding in HTTP/1.0
+            stream = datas
+            try:
+                datas = b''.join(stream)
+            except HttpError as e: # the stream failed, nothing is sent yet
+                status, keepalive, response_headers = e.status, False, {}
+                datas = errorhtml(status, response_headers)
+            finally:
+                close = getattr(stream, "close", None)
+                if close:
+                    close()
+        if keepalive and not body.finished():
+            # the client never sends a body it was not told to continue with
+            keepalive = not body.expect and body.drain()
+        if keepalive:
+            response_headers["Connection"] = "keep-alive"
+            if ver < 1.1:
+                response_headers["Keep-Alive"] = "timeout=%d" % keepalive_timeout
+        else:
+            response_headers["Connection"] = "close"
+        if info is not None:
+            hooks.before("write", info)
+        writing, queued = time.time(), write_func.sent
+        try:
+            HttpHandler.response(write_func, status, datas, response_headers)
+        except HttpError as e: # a streamed body failed
+            log.warn("response failed:", url, e)
+            if write_func.sent != queued: # too late for a status, never end the body cleanly
+                raise ConnectionError("response aborted: {}".format(e))
+            status, keepalive, response_headers = e.status, False, {"Connection": "close"}
+            HttpHandler.response(write_func, status, errorhtml(status, response_headers), response_headers)
+        seconds = time.time() - writing
+        metrics.observe("write", seconds)
+        if info is not None:
+            info["sent"] = write_func.sent - sent
+            hooks.after("write", info, seconds)
+    finally:
+        if info is not None:
+            hooks.local.info = None
+        body.close()
+        sent = write_func.sent - sent
+        metrics.inc(("requests", method or "-", status))
+        metrics.inc(("bytes_sent",), sent)
+        log.access(addr, method, url, status, sent, time.time() - started)
+    return keepalive
+
+def handle_socket(client_sock, addr):
+    if not conn_limits.acquire(addr[0]):
+        metrics.inc(("rejected",))
+        refuse(client_sock, 429)
+        return
+    metrics.inc(("connections_opened",))
+    read_func = HttpHandler.read_func(client_sock)
+    write_func = HttpHandler.write_func(client_sock)
+    live_conns.add(read_func)
+    served = 0
+    try:
+        while True:
+            if served:
+                read_func.expect("idle", keepalive_timeout)
+            parsed = HttpHandler.parse(read_func, write_func)
+            if parsed is None: # client closed the connection
+                break
+            read_func.expect("body")
+            served += 1
+            read_func.served = served
+            if not serve_request(parsed, write_func, served, addr) or draining:
+                break
+    except socket.timeout as e:
+        if read_func.phase == "header": # stalled in the middle of a head
+            log.debug("request timed out:", addr, e)
+            client_sock.setblocking(False)
+            try:
+                client_sock.send(canned_response(408))
+            except OSError:
+                pass
+        else:
+            log.debug("timeout, close:", addr, e)
+    except (ConnectionError, OSError) as e:
+        log.debug("connection error:", addr, e)
+    finally:
+        live_conns.remove(read_func)
+        client_sock.close()
+        read_func.close()
+        conn_limits.release(addr[0])
+        metrics.inc(("connections_closed",))
+
+def quit(sig, frame):
+    log.info("You stop me:", sig)
+    sys.exit()
+
+def usage():
+    print("Usage: python httpd.py [--host=127.0.0.1] [--port=8787] [--backlog=128] [--engine=thread|loop]")
+    print("           [--pool=N] [--queue=256] [--overload=503|refuse] [--workers=N] [--reuseport]")
+    print("           [--max-body=BYTES] [--cgi-workers=4] [--cgi-max-requests=1000] [--cgi-timeout=30]")
+    print("           [--gzip=6] [--log=FILE] [--log-level=info] [--log-sample=1.0]")
+    print("           [--stats-path=/__stats] [--keepalive-timeout=10] [--header-timeout=10] [--body-timeout=30]")
+    print("           [--body-min-rate=1024] [--write-timeout=60] [--max-header=16384] [--max-conns-per-ip=128]")
+    print("           [--profile=pstats|stacks] [--profile-sample=0.1] [--profile-dir=.]")
+    print("           [--drain-timeout=30] [--pid-file=FILE] [--proxy=PATTERN=HOST:PORT,...]")
+    print("           [--proxy-balance=round-robin|least-conn] [--proxy-keepalive=16] [--proxy-timeout=30]")
+    print("           [--cache=PATTERN] [--cache-ttl=60] [--cache-entries=1024] [--cache-size=BYTES]")
+    print("  --engine    thread: blocking sockets, loop: one selectors event loop for all sockets")
+    print("  --pool      serve with N worker threads instead of one thread per connection,")
+    print("              with --engine=loop the number of handler threads (default 4)")
+    print("  --queue     accepted connections waiting for a worker, beyond that --overload applies")
+    print("  --workers   pre-fork N processes sharing the port, crashed ones are restarted")
+    print("  --reuseport every worker binds its own socket with SO_REUSEPORT instead of inheriting one")
+    print("  --max-body  largest accepted request body (default 64M), bodies over 1M are spooled to disk")
+    print("  --cgi-workers       persistent processes running cgi scripts, 0 spawns python per request")
+    print("  --cgi-max-requests  requests a cgi worker serves before it is recycled")
+    print("  --cgi-timeout       seconds a cgi script may run before it gets 504")
+    print("  --gzip      compression level for clients sending Accept-Encoding: gzip, 0 turns it off")
+    print("  --log       append the log to FILE instead of stdout")
+    print("  --log-level debug|info|warn|error, access records are info")
+    print("  --log-sample  fraction of requests written to the access log, 5xx are always logged")
+    print("  --stats-path  where the prometheus metrics are served, empty turns them off")
+    print("  --header-timeout  seconds for a whole request head, a stalled one gets 408")
+    print("  --body-timeout    longest pause inside a request body, after it the body must average")
+    print("                    --body-min-rate bytes/s, otherwise 408")
+    print("  --max-conns-per-ip  concurrent connections from one address, more get 429, 0 for no cap")
+    print("  --profile   what kill -USR1 toggles: pstats profiles --profile-sample of the requests with")
+    print("              cProfile, stacks samples all threads into collapsed stacks for flamegraphs.")
+    print("              The result is written to --profile-dir when profiling is toggled off")
+    print("  --drain-timeout  SIGTERM stops accepting and gives requests in flight this long to finish,")
+    print("                   SIGHUP starts a new server on the same socket and drains this one")
+    print("  --pid-file  write the pid to FILE, a restarted server writes its own")
+    print("  --proxy     forward requests matching a route pattern to upstreams, e.g. /api/*rest=127.0.0.1:9001,")
+    print("              127.0.0.1:9002. repeatable, --proxy-balance applies to the ones after it")
+    print("  --proxy-keepalive  idle connections kept open per upstream")
+    print("  --cache     cache GET and POST responses of a route pattern, e.g. /color.py, repeatable.")
+    print("              keyed on method, path, query and body, kept --cache-ttl seconds unless the")
+    print("              response's Cache-Control says otherwise, --cache-size bytes (default 64M) in all")
 
 if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", ["help", "host=", "port=", "backlog=", "pool=", "queue=", "overload=", "engine=", "workers=", "reuseport", "max-body=",
+            "cgi-workers=", "cgi-max-requests=", "cgi-timeout=", "cgi-worker", "gzip=", "log=", "log-level=", "log-sample=", "stats-path=",
+            "keepalive-timeout=", "header-timeout=", "body-timeout=", "body-min-rate=", "write-timeout=",
+            "max-header=", "max-conns-per-ip=", "profile=", "profile-sample=", "profile-dir=",
+            "drain-timeout=", "pid-file=", "proxy=", "proxy-balance=", "proxy-keepalive=", "proxy-timeout=",
+            "cache=", "cache-ttl=", "cache-entries=", "cache-size="])
+    except getopt.GetoptError as e:
+        print(e)
+        usage()
+        sys.exit(2)
+    host, port = '127.0.0.1', 8787
+    engine = "thread"
+    workers = 0
+    options = {}
+    pid_file = None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o == "--host":
+            host = a
+        elif o == "--port":
+            port = int(a)
+        elif o == "--backlog":
+            options["backlog"] = int(a)
+        elif o == "--pool":
+            options["pool_size"] = int(a)
+        elif o == "--queue":
+            options["queue_size"] = int(a)
+        elif o == "--overload":
+            options["overload"] = a
+        elif o == "--engine":
+            engine = a
+        elif o == "--workers":
+            workers = int(a)
+        elif o == "--reuseport":
+            options["reuseport"] = True
+        elif o == "--max-body":
+            HttpHandler.bodylimits = int(a)
+        elif o == "--cgi-workers":
+            cgi_workers = int(a)
+        elif o == "--cgi-max-requests":
+            cgi_max_requests = int(a)
+        elif o == "--cgi-timeout":
+            cgi_timeout = float(a)
+        elif o == "--gzip":
+            gzip_level = int(a)
+        elif o == "--log":
+            log.stream = open(a, "a")
+        elif o == "--log-level":
+            if a not in AsyncLog.levels:
+                usage()
+                sys.exit(2)
+            log.level = AsyncLog.levels[a]
+        elif o == "--log-sample":
+            log.sample = float(a)
+        elif o == "--stats-path":
+            stats_path = a
+        elif o == "--keepalive-timeout":
+            keepalive_timeout = float(a)
+        elif o == "--header-timeout":
+            header_timeout = float(a)
+        elif o == "--body-timeout":
+            body_timeout = float(a)
+        elif o == "--body-min-rate":
+            body_min_rate = int(a)
+        elif o == "--write-timeout":
+            write_timeout = float(a)
+        elif o == "--max-header":
+            RequestParser.max_header_size = int(a)
+            BufferReader.limit = RequestParser.max_header_size + 65536
+        elif o == "--max-conns-per-ip":
+            max_conns_per_ip = int(a)
+        elif o == "--profile":
+            if a not in Profiler.modes:
+                usage()
+                sys.exit(2)
+            profiler.mode = a
+        elif o == "--profile-sample":
+            profiler.sample = float(a)
+        elif o == "--profile-dir":
+            profiler.directory = a
+        elif o == "--drain-timeout":
+            drain_timeout = float(a)
+        elif o == "--pid-file":
+            pid_file = a
+        elif o == "--proxy":
+            pattern, sep, spec = a.partition("=")
+            if not sep or not spec:
+                usage()
+                sys.exit(2)
+            add_proxy(pattern, spec)
+        elif o == "--proxy-balance":
+            if a not in UpstreamGroup.balances:
+                usage()
+                sys.exit(2)
+            proxy_balance = a
+        elif o == "--proxy-keepalive":
+            proxy_keepalive = int(a)
+        elif o == "--proxy-timeout":
+            proxy_timeout = float(a)
+        elif o == "--cache":
+            response_cache.add(a)
+        elif o == "--cache-ttl":
+            response_cache.ttl = float(a)
+        elif o == "--cache-entries":
+            response_cache.max_entries = int(a)
+        elif o == "--cache-size":
+            response_cache.max_bytes = int(a)
+        elif o == "--cgi-worker": # internal, started by CgiPool
+            cgi_worker_main()
+            sys.exit()
+    router = default_router() # options like --stats-path change the table
+    if engine == "loop":
+        ss, func = EventLoopServer(host, port, **options), serve_request
+    elif engine == "thread":
+        ss, func = SocketServer(host, port, **options), handle_socket
+    else:
+        usage()
+        sys.exit(2)
+    ss.inherited_sock = inherited_listener()
+    if pid_file:
+        with open(pid_file, "w") as f:
+            f.write("{}\n".format(os.getpid()))
     signal.signal(signal.SIGINT, quit)
-    signal.signal(signal.SIGTERM, quit)
-    ss = SocketServer('127.0.0.1', 8787)
-    ss.start(handle_socket)
+    signal.signal(signal.SIGTERM, ss.drain)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, profiler.toggle)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, ss.restart)
+    if workers > 0:
+        PreforkServer(ss, workers).start(func)
+    else:
+        ss.start(func)